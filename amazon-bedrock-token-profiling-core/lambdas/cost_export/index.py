@@ -0,0 +1,330 @@
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import datetime
+from decimal import Decimal
+import io
+import json
+import logging
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+import time
+import traceback
+import zlib
+
+logger = logging.getLogger(__name__)
+if len(logging.getLogger().handlers) > 0:
+    logging.getLogger().setLevel(logging.INFO)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+cost_table_name = os.environ.get("COST_TABLE_NAME", None)
+s3_bucket = os.environ.get("S3_BUCKET", None)
+export_prefix = os.environ.get("EXPORT_PREFIX", "exports")
+export_format = os.environ.get("EXPORT_FORMAT", "ndjson")
+export_total_segments = int(os.environ.get("EXPORT_TOTAL_SEGMENTS", 8))
+export_max_workers = int(os.environ.get("EXPORT_MAX_WORKERS", 8))
+part_size = max(int(os.environ.get("EXPORT_PART_SIZE_MB", 16)), 5) * 1024 * 1024
+parquet_part_rows = int(os.environ.get("EXPORT_PARQUET_PART_ROWS", 50000))
+parquet_compression = os.environ.get("PARQUET_COMPRESSION", "zstd")
+deadline_margin = int(os.environ.get("EXPORT_DEADLINE_MARGIN", 60))
+
+FORMATS = ["ndjson", "parquet"]
+
+# one row per tenant, day and model, rollups and the aggregation version have no date and are not exported
+SCHEMA = pa.schema([
+    ("tenant_id", pa.string()),
+    ("date", pa.string()),
+    ("model_id", pa.string()),
+    ("input_tokens", pa.int64()),
+    ("output_tokens", pa.int64()),
+    ("input_cost", pa.float64()),
+    ("output_cost", pa.float64()),
+    ("saved_cost", pa.float64()),
+    ("invocations", pa.int64()),
+    ("unpriced_invocations", pa.int64()),
+])
+
+# clients are thread safe and shared by the segment workers, adaptive retries slow down on throttling
+s3_client = boto3.client("s3")
+dynamodb_client = boto3.client("dynamodb", config=Config(retries={"max_attempts": 10, "mode": "adaptive"}))
+deserializer = TypeDeserializer()
+
+
+def _to_row(item):
+    row = {}
+    for field in SCHEMA.names:
+        value = deserializer.deserialize(item[field]) if field in item else None
+        if isinstance(value, Decimal):
+            value = int(value) if pa.types.is_integer(SCHEMA.field(field).type) else float(value)
+        row[field] = value
+
+    return row
+
+
+def _get_json(key):
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+
+    return json.loads(response["Body"].read())
+
+
+def _put_json(key, content):
+    s3_client.put_object(Bucket=s3_bucket, Key=key, Body=json.dumps(content, indent=2).encode("utf-8"))
+
+
+class NdjsonWriter:
+    """
+    Gzipped NDJSON in one multipart upload per segment. Every part is a complete gzip member, so the upload can
+    continue from the checkpoint with a new compressor and the object is still a valid gzip file.
+    """
+    def __init__(self, key, checkpoint):
+        self.key = key
+        self.checkpoint = checkpoint
+        self.buffer = io.BytesIO()
+        self.compressor = zlib.compressobj(wbits=31)
+        self.rows = 0
+
+    def write(self, rows):
+        for row in rows:
+            self.buffer.write(self.compressor.compress((json.dumps(row) + "\n").encode("utf-8")))
+        self.rows += len(rows)
+
+    def is_full(self):
+        return self.buffer.tell() >= part_size
+
+    def flush_part(self):
+        self.buffer.write(self.compressor.flush())
+
+        if self.checkpoint["upload_id"] is None:
+            response = s3_client.create_multipart_upload(
+                Bucket=s3_bucket, Key=self.key, ContentType="application/gzip"
+            )
+            self.checkpoint["upload_id"] = response["UploadId"]
+
+        part_number = len(self.checkpoint["parts"]) + 1
+        response = s3_client.upload_part(
+            Bucket=s3_bucket,
+            Key=self.key,
+            UploadId=self.checkpoint["upload_id"],
+            PartNumber=part_number,
+            Body=self.buffer.getvalue()
+        )
+        self.checkpoint["parts"].append({"PartNumber": part_number, "ETag": response["ETag"]})
+
+        self.buffer = io.BytesIO()
+        self.compressor = zlib.compressobj(wbits=31)
+        rows, self.rows = self.rows, 0
+
+        return rows
+
+    def complete(self):
+        s3_client.complete_multipart_upload(
+            Bucket=s3_bucket,
+            Key=self.key,
+            UploadId=self.checkpoint["upload_id"],
+            MultipartUpload={"Parts": self.checkpoint["parts"]}
+        )
+
+        return [self.key]
+
+
+class ParquetWriter:
+    """
+    Parquet files of at most EXPORT_PARQUET_PART_ROWS rows per segment. A Parquet footer can not be appended to
+    after an interruption, so every part is its own object instead of a part of one multipart upload.
+    """
+    def __init__(self, key, checkpoint):
+        self.key = key
+        self.checkpoint = checkpoint
+        self.columns = {field: [] for field in SCHEMA.names}
+        self.rows = 0
+
+    def write(self, rows):
+        for row in rows:
+            for field in SCHEMA.names:
+                self.columns[field].append(row[field])
+        self.rows += len(rows)
+
+    def is_full(self):
+        return self.rows >= parquet_part_rows
+
+    def flush_part(self):
+        if self.rows > 0:
+            part_number = len(self.checkpoint["parts"]) + 1
+            key = f"{self.key}/part-{part_number:05d}.parquet"
+
+            buffer = io.BytesIO()
+            pq.write_table(pa.Table.from_pydict(self.columns, schema=SCHEMA), buffer, compression=parquet_compression)
+            s3_client.put_object(Bucket=s3_bucket, Key=key, Body=buffer.getvalue())
+
+            self.checkpoint["parts"].append({"PartNumber": part_number, "Key": key})
+
+        self.columns = {field: [] for field in SCHEMA.names}
+        rows, self.rows = self.rows, 0
+
+        return rows
+
+    def complete(self):
+        return [part["Key"] for part in self.checkpoint["parts"]]
+
+
+def export_segment(export, segment, deadline=None):
+    """
+    Scans one segment of the cost table into S3, checkpointing after every part.
+
+    The checkpoint holds the scan position of the last uploaded part, rows scanned after it are scanned again
+    when the segment is resumed.
+    """
+    prefix = f"{export_prefix}/{export['export_id']}"
+    checkpoint_key = f"{prefix}/checkpoints/segment-{segment:04d}.json"
+
+    checkpoint = _get_json(checkpoint_key) or {
+        "segment": segment,
+        "status": "running",
+        "exclusive_start_key": None,
+        "items": 0,
+        "upload_id": None,
+        "parts": [],
+        "objects": []
+    }
+    if checkpoint["status"] == "complete":
+        return checkpoint
+
+    if export["format"] == "parquet":
+        writer = ParquetWriter(f"{prefix}/data/segment-{segment:04d}", checkpoint)
+    else:
+        writer = NdjsonWriter(f"{prefix}/data/segment-{segment:04d}.ndjson.gz", checkpoint)
+
+    kwargs = {
+        "TableName": cost_table_name,
+        "Segment": segment,
+        "TotalSegments": export["total_segments"],
+        "FilterExpression": "attribute_exists(#date)",
+        "ExpressionAttributeNames": {"#date": "date"}
+    }
+    start_key = checkpoint["exclusive_start_key"]
+
+    while True:
+        if deadline is not None and time.monotonic() >= deadline:
+            logger.info(f"Segment {segment} stopped at the deadline after {checkpoint['items']} items")
+            return checkpoint
+
+        response = dynamodb_client.scan(**kwargs, **({"ExclusiveStartKey": start_key} if start_key else {}))
+        writer.write([_to_row(item) for item in response["Items"]])
+        start_key = response.get("LastEvaluatedKey")
+
+        if start_key is None or writer.is_full():
+            checkpoint["items"] += writer.flush_part()
+            checkpoint["exclusive_start_key"] = start_key
+
+            if start_key is None:
+                checkpoint["objects"] = writer.complete()
+                checkpoint["status"] = "complete"
+
+            _put_json(checkpoint_key, checkpoint)
+
+            if start_key is None:
+                return checkpoint
+
+
+def process_export(event, context=None):
+    """
+    Exports the daily cost items with EXPORT_MAX_WORKERS segments scanned in parallel.
+
+    The export settings are kept in exports/<export_id>/export.json, invoking again with the same export_id resumes
+    the unfinished segments from their checkpoints and skips the finished ones.
+    """
+    try:
+        export_id = event.get("export_id", datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d"))
+        prefix = f"{export_prefix}/{export_id}"
+
+        export = _get_json(f"{prefix}/export.json")
+        if export is None:
+            export = {
+                "export_id": export_id,
+                "table": cost_table_name,
+                "format": event.get("format", export_format),
+                "total_segments": int(event.get("total_segments", export_total_segments)),
+                "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat()
+            }
+            if export["format"] not in FORMATS:
+                raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+
+            _put_json(f"{prefix}/export.json", export)
+
+        segments = list(range(export["total_segments"]))
+        pending = iter(segments)
+        checkpoints = {}
+        failed = {}
+
+        deadline = None
+        if context is not None:
+            deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - deadline_margin
+
+        with ThreadPoolExecutor(max_workers=export_max_workers) as executor:
+            futures = {}
+
+            while True:
+                # no new segment is started once the deadline is reached, the next invocation picks it up
+                while len(futures) < export_max_workers and (deadline is None or time.monotonic() < deadline):
+                    segment = next(pending, None)
+                    if segment is None:
+                        break
+                    futures[executor.submit(export_segment, export, segment, deadline)] = segment
+
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    segment = futures.pop(future)
+                    try:
+                        checkpoints[segment] = future.result()
+                    except Exception as e:
+                        logger.error(f"Segment {segment} failed: {e}")
+                        failed[segment] = str(e)
+
+        completed = [segment for segment in segments if checkpoints.get(segment, {}).get("status") == "complete"]
+        manifest = {
+            **export,
+            "status": "complete" if len(completed) == len(segments) else "incomplete",
+            "completed": len(completed),
+            "remaining": [segment for segment in segments if segment not in completed],
+            "failed": failed,
+            "items": sum(checkpoints[segment]["items"] for segment in completed),
+            "objects": [key for segment in completed for key in checkpoints[segment]["objects"]],
+            "updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }
+        _put_json(f"{prefix}/manifest.json", manifest)
+
+        logger.info(f"Export {export_id} {manifest['status']}: {manifest['completed']}/{len(segments)} segments, {manifest['items']} items")
+
+        return manifest
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        logger.error(stacktrace)
+
+        raise e
+
+
+def lambda_handler(event, context):
+    try:
+        manifest = process_export(event, context)
+
+        return {
+            "statusCode": 200,
+            "body": json.dumps({key: manifest[key] for key in ["export_id", "status", "completed", "remaining", "failed", "items"]})
+        }
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        logger.error(stacktrace)
+
+        return {"statusCode": 500, "body": str(e)}
@@ -1,11 +1,16 @@
 import boto3
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import datetime
 from io import StringIO
+import json
 import logging
 import os
+import pandas as pd
 import pytz
+import time
 import traceback
-from utils import run_query, results_to_df, calculate_cost
+from reports import write_daily_report, write_raw_records
+from utils import get_deadline, run_aggregate_query, run_query, results_to_df, calculate_costs, write_cost_items
 
 logger = logging.getLogger(__name__)
 if len(logging.getLogger().handlers) > 0:
@@ -15,24 +20,74 @@ else:
 
 log_group_name_api = os.environ.get("LOG_GROUP_API", None)
 s3_bucket = os.environ.get("S3_BUCKET", None)
+cost_table_name = os.environ.get("COST_TABLE_NAME", None)
+query_mode = os.environ.get("QUERY_MODE", "aggregate")
+output_format = os.environ.get("OUTPUT_FORMAT", "csv")
+output_raw = os.environ.get("OUTPUT_RAW", "false").lower() == "true"
+parquet_compression = os.environ.get("PARQUET_COMPRESSION", "zstd")
+daily_prefix = os.environ.get("DAILY_PREFIX", "daily")
+raw_prefix = os.environ.get("RAW_PREFIX", "raw")
+backfill_prefix = os.environ.get("BACKFILL_PREFIX", "backfill")
+backfill_max_workers = int(os.environ.get("BACKFILL_MAX_WORKERS", "2"))
 
-s3_resource = boto3.resource('s3')
+# clients are thread safe, days of a backfill are processed concurrently
+s3_client = boto3.client('s3')
+dynamodb_client = boto3.client('dynamodb')
 
 QUERY_API = """
 fields 
-message.user_id as user_id,
+toMillis(@timestamp) as timestamp,
+message.tenant_id as tenant_id,
 message.requestId as request_id,
 message.region as region,
 message.model_id as model_id,
 message.inputTokens as input_tokens,
 message.outputTokens as output_tokens,
+message.savedInputTokens as saved_input_tokens,
+message.savedOutputTokens as saved_output_tokens,
+message.latency as latency,
 message.height as height,
 message.width as width,
 message.steps as steps
 | filter level = "INFO"
 """
 
-def process_event(event):
+QUERY_API_AGGREGATED = """
+fields
+message.tenant_id as tenant_id,
+message.model_id as model_id,
+coalesce(message.region, "us-east-1") as region,
+message.inputTokens as input_tokens,
+message.outputTokens as output_tokens,
+coalesce(message.savedInputTokens, 0) as saved_input_tokens,
+coalesce(message.savedOutputTokens, 0) as saved_output_tokens,
+coalesce(message.height, 0) as height,
+coalesce(message.width, 0) as width,
+coalesce(message.steps, 0) as steps
+| filter level = "INFO"
+| stats
+sum(input_tokens) as input_tokens,
+sum(output_tokens) as output_tokens,
+sum(saved_input_tokens) as saved_input_tokens,
+sum(saved_output_tokens) as saved_output_tokens,
+count(*) as invocations
+by tenant_id, model_id, region, height, width, steps
+"""
+
+QUERY_API_LATENCY = """
+fields
+message.tenant_id as tenant_id,
+message.model_id as model_id,
+message.latency as latency
+| filter level = "INFO" and ispresent(latency)
+| stats
+pct(latency, 50) as latency_p50,
+pct(latency, 90) as latency_p90,
+pct(latency, 99) as latency_p99
+by tenant_id, model_id
+"""
+
+def process_event(event, context=None):
     try:
         if "date" in event:
             date = event["date"]
@@ -40,31 +95,182 @@ def process_event(event):
             date = datetime.datetime.now(pytz.UTC) - datetime.timedelta(days=1)
             date = date.strftime("%Y-%m-%d")
 
+        # "aggregate" sums the usage inside Logs Insights, "raw" fetches every invocation record for audits
+        mode = event.get("mode", query_mode)
+        # "csv" writes {date}.csv at the bucket root, "parquet" writes typed files under date= prefixes
+        file_format = event.get("format", output_format)
+        write_raw = event.get("raw", output_raw)
+
+        # the raw partition needs every invocation record
+        if write_raw and mode != "raw":
+            logger.warning("Raw output requested, switching the query mode to raw")
+            mode = "raw"
+
+        deadline = get_deadline(context)
+
         # querying the cloudwatch logs from the API
-        query_results_api = run_query(QUERY_API, log_group_name_api, date)
+        start_time = time.perf_counter()
+        if mode == "raw":
+            query_results_api = run_query(QUERY_API, log_group_name_api, date, deadline=deadline)
+        else:
+            query_results_api = run_aggregate_query(QUERY_API_AGGREGATED, log_group_name_api, date, deadline=deadline)
+        logger.info(
+            f"Query mode {mode}: {len(query_results_api)} rows, "
+            f"{len(json.dumps(query_results_api))} bytes, {time.perf_counter() - start_time:.2f}s"
+        )
+
         df_bedrock_cost_tracking = results_to_df(query_results_api)
+        summary = {"date": date, "mode": mode, "format": file_format, "invocations": 0, "cost": 0.0, "files": []}
 
         if len(df_bedrock_cost_tracking) > 0:
-            # Apply the calculate_cost function to the DataFrame
-            df_bedrock_cost_tracking[["input_tokens", "output_tokens", "input_cost", "output_cost", "invocations"]] = df_bedrock_cost_tracking.apply(
-                calculate_cost, axis=1, result_type="expand"
-            )
+            # price all invocations at once against the flattened price list
+            df_bedrock_cost_tracking = calculate_costs(df_bedrock_cost_tracking)
 
             # aggregate cost for each model_id
-            df_bedrock_cost_tracking_aggregated = df_bedrock_cost_tracking.groupby(["user_id", "model_id"]).sum()[
-                ["input_tokens", "output_tokens", "input_cost", "output_cost", "invocations"]
-            ]
+            df_bedrock_cost_tracking_aggregated = df_bedrock_cost_tracking.groupby(["tenant_id", "model_id"])[
+                ["input_tokens", "output_tokens", "input_cost", "output_cost", "saved_cost", "invocations", "unpriced_invocations"]
+            ].sum()
+
+            # latency percentiles per tenant and model, records logged before latency was added are skipped
+            if mode == "raw":
+                if "latency" in df_bedrock_cost_tracking:
+                    df_bedrock_cost_tracking["latency"] = pd.to_numeric(df_bedrock_cost_tracking["latency"], errors="coerce")
+                    df_latency = df_bedrock_cost_tracking.groupby(["tenant_id", "model_id"])["latency"].quantile([0.5, 0.9, 0.99]).unstack()
+                    df_latency.columns = ["latency_p50", "latency_p90", "latency_p99"]
+                    df_bedrock_cost_tracking_aggregated = df_bedrock_cost_tracking_aggregated.join(df_latency)
+            else:
+                df_latency = results_to_df(run_aggregate_query(QUERY_API_LATENCY, log_group_name_api, date, deadline=deadline))
+                if len(df_latency) > 0:
+                    df_latency = df_latency.set_index(["tenant_id", "model_id"])[["latency_p50", "latency_p90", "latency_p99"]]
+                    df_bedrock_cost_tracking_aggregated = df_bedrock_cost_tracking_aggregated.join(df_latency.apply(pd.to_numeric, errors="coerce"))
 
             df_bedrock_cost_tracking_aggregated["date"] = date
 
+            summary["invocations"] = int(df_bedrock_cost_tracking_aggregated["invocations"].sum())
+            summary["cost"] = float(
+                df_bedrock_cost_tracking_aggregated["input_cost"].sum() + df_bedrock_cost_tracking_aggregated["output_cost"].sum()
+            )
+
             logger.info(df_bedrock_cost_tracking_aggregated.to_string())
 
-            csv_buffer = StringIO()
-            df_bedrock_cost_tracking_aggregated.to_csv(csv_buffer)
+            # the final numbers of the day replace what the manual aggregation wrote during the day
+            if cost_table_name:
+                write_cost_items(df_bedrock_cost_tracking_aggregated.reset_index(), cost_table_name, dynamodb_client)
 
-            file_name = f"{date}.csv"
+            if file_format == "parquet":
+                summary["files"].append(write_daily_report(
+                    s3_client, s3_bucket, daily_prefix, date,
+                    df_bedrock_cost_tracking_aggregated.drop(columns="date"), parquet_compression
+                ))
 
-            s3_resource.Object(s3_bucket, file_name).put(Body=csv_buffer.getvalue())
+                if write_raw:
+                    summary["files"].extend(
+                        write_raw_records(s3_client, s3_bucket, raw_prefix, date, df_bedrock_cost_tracking, parquet_compression)
+                    )
+            else:
+                csv_buffer = StringIO()
+                df_bedrock_cost_tracking_aggregated.to_csv(csv_buffer)
+
+                file_name = f"{date}.csv"
+
+                s3_client.put_object(Bucket=s3_bucket, Key=file_name, Body=csv_buffer.getvalue())
+                summary["files"].append(file_name)
+
+        return summary
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        logger.error(stacktrace)
+
+        raise e
+
+def _get_dates(start_date, end_date):
+    start = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+
+    if end < start:
+        raise ValueError(f"end_date {end_date} is before start_date {start_date}")
+
+    return [(start + datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end - start).days + 1)]
+
+def _load_checkpoints(prefix):
+    checkpoints = {}
+
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=f"{prefix}/checkpoints/"):
+        for obj in page.get("Contents", []):
+            summary = json.loads(s3_client.get_object(Bucket=s3_bucket, Key=obj["Key"])["Body"].read())
+            checkpoints[summary["date"]] = summary
+
+    return checkpoints
+
+def _put_json(key, body):
+    s3_client.put_object(Bucket=s3_bucket, Key=key, Body=json.dumps(body, indent=2), ContentType="application/json")
+
+def process_backfill(event, context=None):
+    """
+    Reprocesses every day from start_date to end_date, both inclusive, with at most BACKFILL_MAX_WORKERS days in flight.
+
+    Finished days are checkpointed under backfill/<backfill_id>/checkpoints/, so invoking again with the same event
+    resumes after a timeout and skips the days already done. Pass "force": true to reprocess them anyway.
+    The reports are written to the same keys as the daily run, re-running a range overwrites them with the same content.
+    """
+    try:
+        dates = _get_dates(event["start_date"], event["end_date"])
+        backfill_id = event.get("backfill_id", f"{dates[0]}_{dates[-1]}")
+        prefix = f"{backfill_prefix}/{backfill_id}"
+
+        day_event = {key: event[key] for key in ["mode", "format", "raw"] if key in event}
+        completed = {} if event.get("force", False) else _load_checkpoints(prefix)
+        pending = iter([date for date in dates if date not in completed])
+        failed = {}
+
+        logger.info(f"Backfill {backfill_id}: {len(dates)} days, {len(completed)} already completed")
+
+        deadline = get_deadline(context)
+
+        with ThreadPoolExecutor(max_workers=backfill_max_workers) as executor:
+            futures = {}
+
+            while True:
+                # no new day is started once the deadline is reached, the next invocation picks it up
+                while len(futures) < backfill_max_workers and (deadline is None or time.monotonic() < deadline):
+                    date = next(pending, None)
+                    if date is None:
+                        break
+                    futures[executor.submit(process_event, {**day_event, "date": date}, context)] = date
+
+                if not futures:
+                    break
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    date = futures.pop(future)
+                    try:
+                        summary = future.result()
+                        _put_json(f"{prefix}/checkpoints/{date}.json", summary)
+                        completed[date] = summary
+                    except Exception as e:
+                        failed[date] = str(e)
+
+        remaining = [date for date in dates if date not in completed]
+        manifest = {
+            "backfill_id": backfill_id,
+            "start_date": dates[0],
+            "end_date": dates[-1],
+            "status": "complete" if not remaining else "incomplete",
+            "completed": len(dates) - len(remaining),
+            "remaining": remaining,
+            "failed": failed,
+            "invocations": sum(completed[date]["invocations"] for date in dates if date in completed),
+            "cost": sum(completed[date]["cost"] for date in dates if date in completed),
+            "days": [completed[date] for date in dates if date in completed],
+            "updated_at": datetime.datetime.now(pytz.UTC).isoformat()
+        }
+        _put_json(f"{prefix}/manifest.json", manifest)
+
+        logger.info(f"Backfill {backfill_id} {manifest['status']}: {manifest['completed']}/{len(dates)} days, {len(failed)} failed")
+
+        return manifest
     except Exception as e:
         stacktrace = traceback.format_exc()
         logger.error(stacktrace)
@@ -73,7 +279,11 @@ def process_event(event):
 
 def lambda_handler(event, context):
     try:
-        process_event(event)
+        if "start_date" in event:
+            manifest = process_backfill(event, context)
+            return {"statusCode": 200, "body": json.dumps({key: manifest[key] for key in ["status", "completed", "remaining", "failed"]})}
+
+        process_event(event, context)
         return {"statusCode": 200, "body": "OK"}
     except Exception as e:
         stacktrace = traceback.format_exc()
@@ -0,0 +1,109 @@
+import io
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+if len(logging.getLogger().handlers) > 0:
+    logging.getLogger().setLevel(logging.INFO)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+# Partition columns (date, tenant_id for the raw records) are encoded in the object key, not in the files
+DAILY_SCHEMA = pa.schema([
+    ("tenant_id", pa.string()),
+    ("model_id", pa.string()),
+    ("input_tokens", pa.int64()),
+    ("output_tokens", pa.int64()),
+    ("input_cost", pa.float64()),
+    ("output_cost", pa.float64()),
+    ("saved_cost", pa.float64()),
+    ("invocations", pa.int64()),
+    ("unpriced_invocations", pa.int64()),
+    ("latency_p50", pa.float64()),
+    ("latency_p90", pa.float64()),
+    ("latency_p99", pa.float64()),
+])
+
+RAW_SCHEMA = pa.schema([
+    ("timestamp", pa.timestamp("ms", tz="UTC")),
+    ("request_id", pa.string()),
+    ("model_id", pa.string()),
+    ("region", pa.string()),
+    ("input_tokens", pa.int64()),
+    ("output_tokens", pa.int64()),
+    ("saved_input_tokens", pa.int64()),
+    ("saved_output_tokens", pa.int64()),
+    ("input_cost", pa.float64()),
+    ("output_cost", pa.float64()),
+    ("saved_cost", pa.float64()),
+    ("latency", pa.float64()),
+])
+
+
+def to_table(df, schema):
+    """
+    Casts the dataframe to the schema, missing columns are written as nulls so every file has the same layout
+    """
+    columns = {}
+
+    for field in schema:
+        if field.name not in df:
+            columns[field.name] = pa.nulls(len(df), type=field.type)
+        elif pa.types.is_string(field.type):
+            columns[field.name] = pa.array(df[field.name].astype(str), type=field.type)
+        elif pa.types.is_timestamp(field.type):
+            values = pd.to_datetime(pd.to_numeric(df[field.name], errors="coerce"), unit="ms", utc=True)
+            columns[field.name] = pa.array(values, type=field.type)
+        elif pa.types.is_integer(field.type):
+            values = pd.to_numeric(df[field.name], errors="coerce").fillna(0).astype("int64")
+            columns[field.name] = pa.array(values, type=field.type)
+        else:
+            columns[field.name] = pa.array(pd.to_numeric(df[field.name], errors="coerce"), type=field.type, from_pandas=True)
+
+    return pa.table(columns, schema=schema)
+
+
+def to_parquet(table, compression="zstd", row_group_size=100000):
+    buffer = io.BytesIO()
+    pq.write_table(
+        table,
+        buffer,
+        compression=compression,
+        row_group_size=row_group_size,
+        write_statistics=True
+    )
+
+    return buffer.getvalue()
+
+
+def write_daily_report(s3_client, bucket, prefix, date, df_aggregated, compression="zstd"):
+    table = to_table(df_aggregated.reset_index(), DAILY_SCHEMA)
+
+    key = f"{prefix}/date={date}/costs.parquet"
+    s3_client.put_object(Bucket=bucket, Key=key, Body=to_parquet(table, compression))
+    logger.info(f"Wrote {table.num_rows} rows to s3://{bucket}/{key}")
+
+    return key
+
+
+def write_raw_records(s3_client, bucket, prefix, date, df, compression="zstd"):
+    """
+    Writes the priced invocation records partitioned by date and tenant_id, sorted by model_id and
+    timestamp so the row group statistics can prune on both
+    """
+    keys = []
+
+    for tenant_id, df_tenant in df.groupby("tenant_id"):
+        df_tenant = df_tenant.sort_values([column for column in ["model_id", "timestamp"] if column in df_tenant])
+        table = to_table(df_tenant, RAW_SCHEMA)
+
+        key = f"{prefix}/date={date}/tenant_id={quote(str(tenant_id), safe='')}/records.parquet"
+        s3_client.put_object(Bucket=bucket, Key=key, Body=to_parquet(table, compression))
+        keys.append(key)
+
+    logger.info(f"Wrote {len(df)} records in {len(keys)} tenant partitions to s3://{bucket}/{prefix}/date={date}/")
+
+    return keys
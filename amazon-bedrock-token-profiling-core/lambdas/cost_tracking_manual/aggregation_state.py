@@ -0,0 +1,123 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+if len(logging.getLogger().handlers) > 0:
+    logging.getLogger().setLevel(logging.INFO)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+RECORD_TYPE = "watermark"
+
+
+class AggregationState:
+    """
+    Per day watermark stored as a watermark#<date> item, the running totals are the day's items in the cost table.
+
+    Logs up to the watermark are already added to the cost table. The next run queries from
+    overlap_start, log lines ingested late inside the overlap are picked up and the request ids
+    seen since overlap_start are skipped so nothing is counted twice. At most max_request_ids ids
+    are kept, so the item stays far below the DynamoDB item size limit.
+    """
+
+    def __init__(self, table, date, overlap=300, max_request_ids=5000, ttl_days=2):
+        self.table = table
+        self.date = date
+        self.overlap = overlap
+        self.max_request_ids = max_request_ids
+        self.ttl_days = ttl_days
+        self.loaded_watermark = None
+        self.watermark = None
+        self.overlap_start = None
+        self.request_ids = {}
+
+    @staticmethod
+    def get_key(date):
+        return f"{RECORD_TYPE}#{date}"
+
+    def load(self):
+        item = self.table.get_item(Key={"pk": self.get_key(self.date)}, ConsistentRead=True).get("Item")
+        if item is None:
+            return
+
+        self.watermark = self.loaded_watermark = int(item["watermark"])
+        self.overlap_start = int(item["overlap_start"])
+        self.request_ids = {request_id: int(timestamp) for request_id, timestamp in item.get("request_ids", {}).items()}
+
+    def get_start_time(self, day_start):
+        if self.overlap_start is None:
+            return day_start
+
+        return max(day_start, self.overlap_start)
+
+    def filter_new(self, df):
+        """
+        Drops rows whose request id was already merged by a previous run
+        """
+        if not self.request_ids or "request_id" not in df.columns:
+            return df
+
+        return df[~df["request_id"].isin(self.request_ids.keys())]
+
+    def advance(self, watermark, df):
+        """
+        Moves the watermark and keeps the request ids that the next overlap can return again
+        """
+        overlap_start = watermark - self.overlap
+
+        request_ids = {request_id: timestamp for request_id, timestamp in self.request_ids.items() if timestamp >= overlap_start}
+        if "request_id" in df.columns and "timestamp" in df.columns:
+            timestamps = df["timestamp"].astype("int64") // 1000
+            recent = timestamps >= overlap_start
+            request_ids.update(
+                (request_id, int(timestamp)) for request_id, timestamp in zip(df.loc[recent, "request_id"], timestamps[recent])
+            )
+
+        # on busy days shrink the overlap to whole seconds holding at most the newest max_request_ids requests
+        if len(request_ids) > self.max_request_ids:
+            timestamps = sorted(request_ids.values(), reverse=True)
+            cutoff = timestamps[self.max_request_ids - 1]
+            if timestamps[self.max_request_ids] == cutoff:
+                cutoff += 1
+            request_ids = {request_id: timestamp for request_id, timestamp in request_ids.items() if timestamp >= cutoff}
+            overlap_start = cutoff
+            logger.warning(f"Overlap shrunk to {watermark - overlap_start} seconds to keep {len(request_ids)} request ids")
+
+        self.watermark = watermark
+        self.overlap_start = overlap_start
+        self.request_ids = request_ids
+
+    def save(self):
+        """
+        Writes the state unless a concurrent run moved the watermark since it was loaded
+        """
+        if self.loaded_watermark is None:
+            condition = {"ConditionExpression": "attribute_not_exists(pk)"}
+        else:
+            condition = {
+                "ConditionExpression": "watermark = :watermark",
+                "ExpressionAttributeValues": {":watermark": self.loaded_watermark}
+            }
+
+        try:
+            self._put(condition)
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            logger.warning(f"Watermark for {self.date} was moved by a concurrent run, state not saved")
+            return False
+
+        return True
+
+    def _put(self, condition):
+        self.table.put_item(
+            **condition,
+            Item={
+                "pk": self.get_key(self.date),
+                "record_type": RECORD_TYPE,
+                "date": self.date,
+                "watermark": self.watermark,
+                "overlap_start": self.overlap_start,
+                "request_ids": self.request_ids,
+                "ttl": int(time.time()) + self.ttl_days * 24 * 3600
+            }
+        )
+
@@ -3,9 +3,12 @@ import datetime
 from io import StringIO
 import logging
 import os
+import pandas as pd
 import pytz
+import time
 import traceback
-from utils import run_query, results_to_df, calculate_cost
+from aggregation_state import AggregationState
+from utils import COST_METRICS, get_deadline, run_query, results_to_df, calculate_costs, add_cost_items, read_day_cost_items
 import json
 
 logger = logging.getLogger(__name__)
@@ -16,65 +19,80 @@ else:
 
 log_group_name_api = os.environ.get("LOG_GROUP_API", None)
 s3_bucket = os.environ.get("S3_BUCKET", None)
+table_name = os.environ.get("TABLE_NAME", None)
+cost_table_name = os.environ.get("COST_TABLE_NAME", None)
+watermark_overlap = int(os.environ.get("WATERMARK_OVERLAP", "300"))
+watermark_max_request_ids = int(os.environ.get("WATERMARK_MAX_REQUEST_IDS", "5000"))
 
 s3_resource = boto3.resource('s3')
+dynamodb_client = boto3.client('dynamodb')
+table = boto3.resource('dynamodb').Table(table_name) if table_name else None
 
 QUERY_API = """
 fields 
+toMillis(@timestamp) as timestamp,
 message.tenant_id as tenant_id,
 message.requestId as request_id,
 message.region as region,
 message.model_id as model_id,
 message.inputTokens as input_tokens,
-message.outputTokens as output_tokens
+message.outputTokens as output_tokens,
+message.savedInputTokens as saved_input_tokens,
+message.savedOutputTokens as saved_output_tokens
 | filter level = "INFO"
 """
 
-def process_event(event):
+def process_event(event, context=None):
     print(event)
     try:
-        date = datetime.datetime.now(pytz.UTC)
-        date = date.strftime("%Y-%m-%d")
+        now = datetime.datetime.now(pytz.UTC)
+        date = now.strftime("%Y-%m-%d")
+        day_start = int(now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+        watermark = int(now.timestamp())
         print(date)
 
+        # only the logs after the last run's watermark are queried, earlier ones are already aggregated
+        state = AggregationState(table, date, overlap=watermark_overlap, max_request_ids=watermark_max_request_ids)
+        state.load()
+        start_time = state.get_start_time(day_start)
+        logger.info(f"Querying {watermark - start_time} seconds since {start_time}, previous watermark {state.watermark}")
+
         # querying the cloudwatch logs from the API
-        query_results_api = run_query(QUERY_API, log_group_name_api, date)
-        df_bedrock_cost_tracking = results_to_df(query_results_api)
+        query_start = time.perf_counter()
+        query_results_api = run_query(
+            QUERY_API, log_group_name_api, deadline=get_deadline(context), time_range=(start_time, watermark)
+        )
+        df_delta = results_to_df(query_results_api)
+        logger.info(f"Delta query returned {len(df_delta)} rows in {time.perf_counter() - query_start:.2f}s")
+
+        df_delta_aggregated = None
+        if len(df_delta) > 0:
+            df_new = state.filter_new(df_delta)
+
+            if len(df_new) > 0:
+                # price all invocations at once against the flattened price list
+                df_new = calculate_costs(df_new)
+
+                # aggregate the delta for each model_id, it is added to the day's items in the cost table
+                df_delta_aggregated = df_new.groupby(["tenant_id", "model_id"])[COST_METRICS].sum().reset_index()
+                df_delta_aggregated["date"] = date
 
-        if len(df_bedrock_cost_tracking) > 0:
-            # Apply the calculate_cost function to the DataFrame
-            df_bedrock_cost_tracking[["input_tokens", "output_tokens", "input_cost", "output_cost", "invocations"]] = df_bedrock_cost_tracking.apply(
-                calculate_cost, axis=1, result_type="expand"
-            )
+        # the watermark is saved first, a concurrent run that moved it already counted this delta.
+        # A failure before the costs are added undercounts the day until the daily cost tracking run.
+        state.advance(watermark, df_delta)
+        if not state.save():
+            return
 
-            # aggregate cost for each model_id
-            df_bedrock_cost_tracking_aggregated = df_bedrock_cost_tracking.groupby(["tenant_id", "model_id"]).sum()[
-                ["input_tokens", "output_tokens", "input_cost", "output_cost", "invocations"]
-            ]
+        if df_delta_aggregated is not None:
+            df_totals = add_cost_items(df_delta_aggregated, cost_table_name, dynamodb_client)
 
-            df_bedrock_cost_tracking_aggregated["date"] = date
+            # the day's items, with the totals read back after adding in case the index is not updated yet
+            df_day = read_day_cost_items(date, cost_table_name, dynamodb_client)
+            df_bedrock_cost_tracking_aggregated = pd.concat([df_day, df_totals]).drop_duplicates(
+                ["tenant_id", "model_id"], keep="last"
+            ).set_index(["tenant_id", "model_id"])[COST_METRICS + ["date"]]
 
-            flat_df = df_bedrock_cost_tracking_aggregated.reset_index()
             print(df_bedrock_cost_tracking_aggregated)
-            dynamodb_client = boto3.client('dynamodb')
-            ddb_table = os.environ.get("TABLE_NAME")
-            for index, row in flat_df.iterrows():
-                #print({"tenant_id": row[0], "model_id": row[1], 'input_tokens': row[2], "output_tokens": row[3], 'input_cost': row[4], "output_cost": row[5], "invocations": row[6], 'date': row[7]})
-                pk=str(row[0])+"-"+str(row[1])
-                dynamodb_client.put_item(
-                    TableName=ddb_table,
-                    Item={
-                        'pk': {'S': pk},
-                        'name': {'S': str(row[0])},
-                        'model_id': {'S': str(row[1])},
-                        'input_tokens': {'S': str(row[2])},
-                        'output_tokens': {'S': str(row[3])},
-                        'input_cost': {'S': str(row[4])},
-                        'output_cost': {'S': str(row[5])},
-                        'invocations': {'S': str(row[6])},
-                        'date': {'S': str(row[7])},
-                    }
-                )
             logger.info(df_bedrock_cost_tracking_aggregated.to_string())
 
             csv_buffer = StringIO()
@@ -90,7 +108,7 @@ def process_event(event):
 
 def lambda_handler(event, context):
     try:
-        process_event(event)
+        process_event(event, context)
         return {
             "statusCode": 200, 
             'headers': {
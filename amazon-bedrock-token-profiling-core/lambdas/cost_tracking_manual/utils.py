@@ -1,11 +1,20 @@
 import boto3
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
+from decimal import Decimal
 import json
 import logging
+import numpy as np
+import os
 import pandas as pd
 import pytz
+import random
+import threading
 import time
 import traceback
+from types import MappingProxyType
 
 logger = logging.getLogger(__name__)
 if len(logging.getLogger().handlers) > 0:
@@ -13,6 +22,43 @@ if len(logging.getLogger().handlers) > 0:
 else:
     logging.basicConfig(level=logging.INFO)
 
+pricing_fallback_region = os.environ.get("PRICING_FALLBACK_REGION", None)
+
+# maximum number of rows a single Logs Insights query returns
+QUERY_RESULTS_LIMIT = 10000
+
+# each worker has at most one query running, keep it below the account's concurrent query quota
+query_shards = int(os.environ.get("QUERY_SHARDS", 24))
+query_max_concurrency = int(os.environ.get("QUERY_MAX_CONCURRENCY", 5))
+query_deadline_margin = int(os.environ.get("QUERY_DEADLINE_MARGIN", 60))
+
+POLL_INITIAL_DELAY = 0.5
+POLL_MAX_DELAY = 10
+
+write_max_concurrency = int(os.environ.get("WRITE_MAX_CONCURRENCY", 8))
+write_max_attempts = int(os.environ.get("WRITE_MAX_ATTEMPTS", 8))
+cost_rollups = os.environ.get("COST_ROLLUPS", "true").lower() == "true"
+
+# BatchWriteItem accepts at most 25 put requests, BatchGetItem at most 100 keys
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+
+# a transaction holds at most 100 items, 24 daily items touch at most 24 * 2 tenant rollups and 24 day rollups
+TRANSACTION_CHUNK_SIZE = 24
+
+# tenant_id of the rollups across all tenants
+ROLLUP_ALL_TENANTS = "#all"
+
+# bumped after every change to the cost table, the retrieval function drops its cached responses on a new version
+AGGREGATION_VERSION_KEY = {"tenant_id": "#meta", "sk": "aggregation_version"}
+
+COST_METRICS = ["input_tokens", "output_tokens", "input_cost", "output_cost", "saved_cost", "invocations", "unpriced_invocations"]
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+_pricing_indexes = {}
+
 def _read_model_list(filename):
     try:
         with open(filename, "r", encoding="utf-8") as f:
@@ -25,107 +71,323 @@ def _read_model_list(filename):
 
         raise e
 
-def get_model_pricing(model_id, MODEL_PRICES):
-    matched = [v for k, v in MODEL_PRICES.items() if model_id in k]
-    if not matched:
-        return None
-    else:
-        return matched[0]
+class PricingIndex:
+    """
+    Immutable index over models.json mapping (model_id, region) to a price entry.
+
+    Model ids are resolved by exact match, then without a cross-region inference profile prefix,
+    then by the longest versioned prefix (e.g. "amazon.titan-text-express-v1:0:8k") and finally by the
+    unversioned id when a single priced version exists. Resolutions are memoized so repeated lookups are O(1).
+    Regions without a price fall back to fallback_region when it is set, every other miss is counted.
+    """
+
+    INFERENCE_PROFILE_PREFIXES = ("us.", "eu.", "apac.", "us-gov.")
+
+    def __init__(self, model_list, fallback_region=None):
+        entries = {}
+
+        for model_type in ["text", "embeddings"]:
+            for model_id, regions in model_list.get(model_type, {}).items():
+                entries[model_id] = MappingProxyType({
+                    region: MappingProxyType({
+                        "model_type": model_type,
+                        "input_price": float(prices["input_cost"]),
+                        "output_price": float(prices["output_cost"])
+                    })
+                    for region, prices in regions.items()
+                })
+
+        for model_id, regions in model_list.get("image", {}).items():
+            entries[model_id] = MappingProxyType({
+                region: MappingProxyType({
+                    "model_type": "image",
+                    "small_standard_price": float(sizes["512x512"]["standard"]),
+                    "small_premium_price": float(sizes["512x512"]["premium"]),
+                    "large_standard_price": float(sizes["larger"]["standard"]),
+                    "large_premium_price": float(sizes["larger"]["premium"])
+                })
+                for region, sizes in regions.items()
+            })
+
+        base_ids = {}
+        for model_id in entries:
+            base_ids.setdefault(model_id.split(":")[0], []).append(model_id)
+
+        self.entries = MappingProxyType(entries)
+        self.base_ids = MappingProxyType({k: v[0] for k, v in base_ids.items() if len(v) == 1})
+        self.fallback_region = fallback_region
+        self.resolved = {}
+        self.misses = Counter()
+
+    def resolve_model_id(self, model_id):
+        if model_id in self.resolved:
+            return self.resolved[model_id]
+
+        candidate = model_id
+        if candidate not in self.entries:
+            for prefix in self.INFERENCE_PROFILE_PREFIXES:
+                if candidate.startswith(prefix):
+                    candidate = candidate[len(prefix):]
+                    break
+
+        resolved = None
+        if candidate in self.entries:
+            resolved = candidate
+        else:
+            parts = candidate.split(":")
+            for i in range(len(parts) - 1, 0, -1):
+                prefix = ":".join(parts[:i])
+                if prefix in self.entries:
+                    resolved = prefix
+                    break
 
-def run_query(query, log_group_name, date=None):
-    cloudwatch = boto3.client("logs")
+            if resolved is None:
+                resolved = self.base_ids.get(parts[0])
+
+        self.resolved[model_id] = resolved
 
-    max_retries = 5
+        return resolved
 
+    def lookup(self, model_id, region):
+        resolved = self.resolve_model_id(model_id) if isinstance(model_id, str) else None
+        if resolved is None:
+            return None
+
+        regions = self.entries[resolved]
+        if region in regions:
+            return regions[region]
+
+        return regions.get(self.fallback_region)
+
+    def record_miss(self, model_id, region, count=1):
+        self.misses[(model_id, region)] += count
+
+    def report_misses(self):
+        misses = dict(self.misses)
+        self.misses.clear()
+
+        for (model_id, region), count in misses.items():
+            logger.warning(f"No price found for model {model_id} in region {region}: {count} invocations")
+
+        return misses
+
+def get_pricing_index(filename="./models.json"):
+    """
+    Loads the pricing index once per container
+    """
+    if filename not in _pricing_indexes:
+        _pricing_indexes[filename] = PricingIndex(
+            _read_model_list(filename),
+            fallback_region=pricing_fallback_region
+        )
+
+    return _pricing_indexes[filename]
+
+def _get_day_range(date=None):
     if date is None:
         date = datetime.datetime.now(pytz.UTC) - datetime.timedelta(days=1)
     else:
-        date = datetime.datetime.strptime(date, "%Y-%m-%d")
+        date = datetime.datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=pytz.UTC)
 
     start = date.replace(hour=0, minute=0, second=0, microsecond=0)
     end = date.replace(hour=23, minute=59, second=59, microsecond=0)
 
-    response = cloudwatch.start_query(
+    # Logs Insights time ranges are inclusive and expressed in epoch seconds
+    return int(start.timestamp()), int(end.timestamp())
+
+def _get_field(result, field):
+    for item in result:
+        if item["field"] == field:
+            return item["value"]
+
+    return None
+
+def _dedup_results(results, dedup_field):
+    seen = set()
+    deduped = []
+
+    for result in results:
+        key = _get_field(result, dedup_field)
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        deduped.append(result)
+
+    return deduped
+
+def _start_query(cloudwatch, deadline=None, **kwargs):
+    max_retries = 8
+
+    for attempt in range(max_retries + 1):
+        try:
+            return cloudwatch.start_query(**kwargs)
+        except cloudwatch.exceptions.LimitExceededException:
+            if attempt == max_retries:
+                raise
+
+            # the account's concurrent query quota is shared with other callers, back off with full jitter
+            delay = random.uniform(0, min(30, 2 ** attempt))
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(f"Query for {kwargs['startTime']}-{kwargs['endTime']} could not be started before the deadline")
+
+            time.sleep(delay)
+
+class QueryStatistics:
+    """
+    Thread-safe totals of the statistics Logs Insights reports for every query
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {"queries": 0, "recordsMatched": 0.0, "recordsScanned": 0.0, "bytesScanned": 0.0}
+
+    def add(self, statistics):
+        with self.lock:
+            self.totals["queries"] += 1
+            for k in ["recordsMatched", "recordsScanned", "bytesScanned"]:
+                self.totals[k] += statistics.get(k, 0.0)
+
+    def to_dict(self):
+        with self.lock:
+            return dict(self.totals)
+
+def _run_window_query(cloudwatch, query, log_group_name, start_time, end_time, deadline=None, statistics=None):
+    response = _start_query(
+        cloudwatch,
+        deadline=deadline,
         logGroupName=log_group_name,
-        startTime=int(start.timestamp() * 1000),
-        endTime=int(end.timestamp() * 1000),
+        startTime=start_time,
+        endTime=end_time,
         queryString=query,
+        limit=QUERY_RESULTS_LIMIT
     )
 
     query_id = response["queryId"]
 
-    retry_count = 0
+    delay = POLL_INITIAL_DELAY
 
     while True:
         response = cloudwatch.get_query_results(queryId=query_id)
+        status = response["status"]
 
-        if response["results"] or retry_count == max_retries:
-            break
+        # results of a query that is still running are partial
+        if status == "Complete":
+            if statistics is not None:
+                statistics.add(response.get("statistics", {}))
 
-        time.sleep(2)
-        retry_count += 1
+            return response["results"]
 
-    return response["results"]
+        if status not in ["Scheduled", "Running"]:
+            raise Exception(f"Query {query_id} for {start_time}-{end_time} ended with status {status}")
 
-def model_price_embeddings(model_list, row):
-    input_token_count = float(row["input_tokens"]) if "input_tokens" in row else 0.0
-    output_token_count = float(row["output_tokens"]) if "output_tokens" in row else 0.0
-    region = row["region"] if "region" in row else "us-east-1"
+        if deadline is not None and time.monotonic() + delay > deadline:
+            cloudwatch.stop_query(queryId=query_id)
+            raise TimeoutError(f"Query {query_id} for {start_time}-{end_time} did not complete before the deadline")
 
-    model_id = row["model_id"]
+        time.sleep(random.uniform(delay / 2, delay))
+        delay = min(delay * 2, POLL_MAX_DELAY)
 
-    # get model pricing for each region
-    model_pricing = get_model_pricing(model_id, model_list)
-    model_pricing = get_model_pricing(region, model_pricing)
+def _run_split_query(cloudwatch, query, log_group_name, start_time, end_time, deadline=None, statistics=None):
+    results = _run_window_query(cloudwatch, query, log_group_name, start_time, end_time, deadline, statistics)
 
-    # calculate costs of prompt and completion
-    input_cost = input_token_count * model_pricing["input_cost"] / 1000
-    output_cost = output_token_count * model_pricing["output_cost"] / 1000
+    if len(results) < QUERY_RESULTS_LIMIT:
+        return results
 
-    return input_token_count, output_token_count, input_cost, output_cost
+    # the halves share their boundary second, a window of two seconds would split into itself
+    if end_time - start_time <= 1:
+        logger.error(f"Window {start_time}-{end_time} has more than {QUERY_RESULTS_LIMIT} records and cannot be split further")
+        return results
 
-def model_price_image(model_list, row):
-    height = float(row["height"]) if "height" in row else 0.0
-    width = float(row["width"]) if "width" in row else 0.0
-    steps = float(row["steps"]) if "steps" in row else 0.0
-    region = row["region"] if "region" in row else "us-east-1"
+    # the window hit the Logs Insights row cap, query both halves instead. Both halves include the middle second,
+    # events within it are not lost however endTime is rounded and run_query drops the duplicates by request id
+    middle = (start_time + end_time) // 2
+    logger.info(f"Splitting window {start_time}-{end_time} at {middle}")
 
-    model_id = row["model_id"]
+    return (
+        _run_split_query(cloudwatch, query, log_group_name, start_time, middle, deadline, statistics)
+        + _run_split_query(cloudwatch, query, log_group_name, middle, end_time, deadline, statistics)
+    )
 
-    # get model pricing from utils
-    model_pricing = get_model_pricing(model_id, model_list)
-    model_pricing = get_model_pricing(region, model_pricing)
+def _get_shards(start_time, end_time, shards):
+    """
+    Adjacent shards share their boundary second like the halves of a split window, run_query drops the duplicates
+    """
+    if end_time - start_time <= 1:
+        return [(start_time, end_time)]
+
+    shard_size = max(1, (end_time - start_time) // shards)
+
+    shard_ranges = []
+    shard_start = start_time
+    while shard_start < end_time:
+        shard_end = min(shard_start + shard_size, end_time)
+        if len(shard_ranges) == shards - 1:
+            shard_end = end_time
+        shard_ranges.append((shard_start, shard_end))
+        shard_start = shard_end
+
+    return shard_ranges
+
+def iter_query_shards(query, log_group_name, date=None, shards=None, max_concurrency=None, deadline=None, statistics=None, time_range=None):
+    """
+    Runs the query over the day (or time_range, in epoch seconds) split into shards, with at most
+    max_concurrency queries in flight. Results are yielded per shard as soon as the shard finishes.
+    """
+    cloudwatch = boto3.client("logs")
 
-    if width <= 512 and height <= 512:
-        size = "512x512"
-    else:
-        size = "larger"
+    start_time, end_time = time_range if time_range is not None else _get_day_range(date)
 
-    model_pricing = get_model_pricing(size, model_pricing)
+    # short ranges get fewer shards, at most one per hour
+    shards = max(1, min(shards or query_shards, (end_time - start_time + 1) // 3600))
+    max_concurrency = max_concurrency or query_max_concurrency
 
-    if steps > 50:
-        price = model_pricing["premium"]
-    else:
-        price = model_pricing["standard"]
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [
+            executor.submit(_run_split_query, cloudwatch, query, log_group_name, shard_start, shard_end, deadline, statistics)
+            for shard_start, shard_end in _get_shards(start_time, end_time, shards)
+        ]
+
+        for future in as_completed(futures):
+            yield future.result()
+
+def get_deadline(context=None):
+    """
+    Monotonic deadline for the queries, leaving QUERY_DEADLINE_MARGIN seconds of the invocation for processing
+    """
+    if context is None:
+        return None
+
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - query_deadline_margin
 
-    return 0.0, 0.0, 0.0, price
+def run_query(query, log_group_name, date=None, dedup_field="request_id", deadline=None, time_range=None):
+    results = []
+    statistics = QueryStatistics()
 
-def model_price_text(model_list, row):
-    input_token_count = float(row["input_tokens"]) if "input_tokens" in row else 0.0
-    output_token_count = float(row["output_tokens"]) if "output_tokens" in row else 0.0
-    region = row["region"] if "region" in row else "us-east-1"
+    for shard_results in iter_query_shards(query, log_group_name, date, deadline=deadline, statistics=statistics, time_range=time_range):
+        results.extend(shard_results)
+
+    logger.info(f"Query statistics: {statistics.to_dict()}")
+
+    return _dedup_results(results, dedup_field)
+
+def run_aggregate_query(query, log_group_name, date=None, deadline=None):
+    """
+    Runs a stats query over the whole day in a single window, its grouped rows cannot be merged across shards
+    """
+    cloudwatch = boto3.client("logs")
+    statistics = QueryStatistics()
 
-    model_id = row["model_id"]
+    start_time, end_time = _get_day_range(date)
 
-    # get model pricing for each region
-    model_pricing = get_model_pricing(model_id, model_list)
-    model_pricing = get_model_pricing(region, model_pricing)
+    results = _run_window_query(cloudwatch, query, log_group_name, start_time, end_time, deadline, statistics)
 
-    # calculate costs of prompt and completion
-    input_cost = input_token_count * model_pricing["input_cost"] / 1000
-    output_cost = output_token_count * model_pricing["output_cost"] / 1000
+    if len(results) >= QUERY_RESULTS_LIMIT:
+        logger.error(f"Aggregate query returned {len(results)} groups, results are truncated")
 
-    return input_token_count, output_token_count, input_cost, output_cost
+    logger.info(f"Query statistics: {statistics.to_dict()}")
+
+    return results
 
 def results_to_df(results):
     column_names = set()
@@ -144,24 +406,399 @@ def results_to_df(results):
 
     return df
 
-def calculate_cost(row):
-    try:
-        model_id = row["model_id"]
+def _get_numeric(df, column):
+    if column not in df:
+        return pd.Series(0.0, index=df.index)
 
-        model_list = _read_model_list("./models.json")
+    return pd.to_numeric(df[column], errors="coerce").fillna(0.0)
 
-        if model_id in list(model_list["text"].keys()):
-            input_token_count, output_token_count, input_cost, output_cost = model_price_text(model_list["text"], row)
-        elif model_id in list(model_list["embeddings"].keys()):
-            input_token_count, output_token_count, input_cost, output_cost = model_price_embeddings(model_list["embeddings"], row)
-        elif model_id in list(model_list["image"].keys()):
-            input_token_count, output_token_count, input_cost, output_cost = model_price_image(model_list["image"], row)
+def calculate_costs(df):
+    try:
+        pricing_index = get_pricing_index()
+
+        keys = pd.DataFrame({
+            "model_id": df["model_id"].values,
+            "region": df["region"].fillna("us-east-1").values if "region" in df else "us-east-1"
+        })
+
+        # resolve every distinct (model_id, region) once, then join the prices onto the invocations
+        pairs = keys.drop_duplicates()
+        price_rows = []
+        for model_id, region in pairs.itertuples(index=False):
+            entry = pricing_index.lookup(model_id, region)
+            price_rows.append({"model_id": model_id, "region": region, **(entry or {"model_type": None})})
+
+        price_columns = [
+            "input_price", "output_price",
+            "small_standard_price", "small_premium_price", "large_standard_price", "large_premium_price"
+        ]
+        price_table = pd.DataFrame(price_rows).reindex(columns=["model_id", "region", "model_type"] + price_columns)
+        price_table[price_columns] = price_table[price_columns].fillna(0.0)
+
+        prices = keys.merge(price_table, how="left", on=["model_id", "region"], validate="many_to_one")
+        prices.index = df.index
+
+        # rows pre-aggregated by a stats query carry their invocation count, raw rows are one invocation each
+        if "invocations" in df:
+            invocations = _get_numeric(df, "invocations").astype(int)
         else:
-            input_token_count, output_token_count, input_cost, output_cost = 0.0, 0.0, 0.0, 0.0
-
-        return input_token_count, output_token_count, input_cost, output_cost, 1
+            invocations = pd.Series(1, index=df.index)
+
+        is_text = prices["model_type"] == "text"
+        is_image = prices["model_type"] == "image"
+        unpriced = prices["model_type"].isna()
+
+        if unpriced.any():
+            misses = keys.assign(invocations=invocations.values)[unpriced.values]
+            for (model_id, region), count in misses.groupby(["model_id", "region"])["invocations"].sum().items():
+                pricing_index.record_miss(model_id, region, int(count))
+            pricing_index.report_misses()
+
+        input_tokens = _get_numeric(df, "input_tokens").where(~is_image, 0.0)
+        output_tokens = _get_numeric(df, "output_tokens").where(~is_image, 0.0)
+
+        input_cost = input_tokens * prices["input_price"] / 1000
+        output_cost = output_tokens * prices["output_price"] / 1000
+
+        # requests answered from the response cache log the tokens they would have been billed for
+        saved_cost = (
+            _get_numeric(df, "saved_input_tokens") * prices["input_price"]
+            + _get_numeric(df, "saved_output_tokens") * prices["output_price"]
+        ) / 1000
+        saved_cost = saved_cost.where(is_text, 0.0)
+
+        # images are priced per image by size and number of steps
+        small = (_get_numeric(df, "width") <= 512) & (_get_numeric(df, "height") <= 512)
+        premium = _get_numeric(df, "steps") > 50
+        image_cost = np.select(
+            [small & ~premium, small & premium, ~small & ~premium],
+            [prices["small_standard_price"], prices["small_premium_price"], prices["large_standard_price"]],
+            prices["large_premium_price"]
+        )
+        output_cost = output_cost.where(~is_image, image_cost)
+
+        return df.assign(
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            input_cost=input_cost,
+            output_cost=output_cost * invocations.where(is_image, 1),
+            saved_cost=saved_cost,
+            invocations=invocations,
+            unpriced_invocations=invocations.where(unpriced, 0)
+        )
     except Exception as e:
         stacktrace = traceback.format_exc()
         logger.error(stacktrace)
 
         raise e
+
+def get_cost_sort_key(date, model_id):
+    return f"{date}#{model_id}"
+
+def _to_number(value):
+    if isinstance(value, float):
+        return Decimal(str(value))
+
+    return Decimal(int(value))
+
+def get_rollup_keys(tenant_id, date):
+    """
+    (tenant_id, sk) of the rollups a daily item is added to: tenant x month, tenant x ISO week and all tenants x day
+    """
+    day = datetime.datetime.strptime(date, "%Y-%m-%d")
+    year, week, _ = day.isocalendar()
+
+    return [
+        (tenant_id, f"month#{day:%Y-%m}"),
+        (tenant_id, f"week#{year}-W{week:02d}"),
+        (ROLLUP_ALL_TENANTS, f"day#{date}"),
+    ]
+
+def _get_cost_item(row):
+    """
+    Cost table item, one per tenant, day and model with numeric metrics
+    """
+    return {
+        "tenant_id": str(row["tenant_id"]),
+        "sk": get_cost_sort_key(row["date"], row["model_id"]),
+        "date": str(row["date"]),
+        "model_id": str(row["model_id"]),
+        **{metric: _to_number(row[metric]) for metric in COST_METRICS if metric in row}
+    }
+
+def _serialize(item):
+    return {key: _serializer.serialize(value) for key, value in item.items()}
+
+def _write_batch(dynamodb_client, table_name, items):
+    requests = [{"PutRequest": {"Item": _serialize(item)}} for item in items]
+
+    for attempt in range(write_max_attempts):
+        response = dynamodb_client.batch_write_item(RequestItems={table_name: requests})
+        requests = response.get("UnprocessedItems", {}).get(table_name, [])
+        if not requests:
+            return
+
+        # unprocessed items are returned when the table is throttled, back off before resending them
+        time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+
+    raise RuntimeError(f"{len(requests)} cost items were still unprocessed after {write_max_attempts} attempts")
+
+def _read_cost_items(dynamodb_client, table_name, items):
+    request = {
+        table_name: {
+            "Keys": [_serialize({"tenant_id": item["tenant_id"], "sk": item["sk"]}) for item in items],
+            "ConsistentRead": True
+        }
+    }
+    current = {}
+
+    for attempt in range(write_max_attempts):
+        response = dynamodb_client.batch_get_item(RequestItems=request)
+        for item in response["Responses"].get(table_name, []):
+            item = {key: _deserializer.deserialize(value) for key, value in item.items()}
+            current[(item["tenant_id"], item["sk"])] = item
+
+        request = response.get("UnprocessedKeys")
+        if not request:
+            return current
+
+        time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+
+    raise RuntimeError(f"Cost items could not be read after {write_max_attempts} attempts")
+
+def _get_rollup_update(table_name, tenant_id, sk, deltas):
+    rollup, period = sk.split("#", 1)
+    values = {":rollup": rollup, ":period": period, **{f":{metric}": deltas[metric] for metric in COST_METRICS}}
+
+    return {
+        "Update": {
+            "TableName": table_name,
+            "Key": _serialize({"tenant_id": tenant_id, "sk": sk}),
+            "UpdateExpression": (
+                "SET #rollup = :rollup, #period = :period "
+                "ADD " + ", ".join(f"{metric} :{metric}" for metric in COST_METRICS)
+            ),
+            "ExpressionAttributeNames": {"#rollup": "rollup", "#period": "period"},
+            "ExpressionAttributeValues": _serialize(values)
+        }
+    }
+
+def _write_transaction(dynamodb_client, table_name, items):
+    """
+    Puts the daily items and adds their change to the rollups in one transaction.
+
+    The change is the difference to the stored item, so writing the same day again adds nothing. Daily items
+    carry a version, the put is conditional on the version that was read and a concurrent change retries with
+    fresh values. Items without a version were written before rollups existed and were never added to them.
+    """
+    for attempt in range(write_max_attempts):
+        current = _read_cost_items(dynamodb_client, table_name, items)
+        transact_items = []
+        rollups = {}
+
+        for item in items:
+            old = current.get((item["tenant_id"], item["sk"]))
+            counted = old if old is not None and "version" in old else {}
+
+            deltas = {metric: item.get(metric, Decimal(0)) - counted.get(metric, Decimal(0)) for metric in COST_METRICS}
+            if counted and not any(deltas.values()):
+                continue
+
+            put = {"TableName": table_name, "Item": _serialize({**item, "version": counted.get("version", 0) + 1})}
+            if old is None:
+                put["ConditionExpression"] = "attribute_not_exists(tenant_id)"
+            elif counted:
+                put["ConditionExpression"] = "version = :version"
+                put["ExpressionAttributeValues"] = _serialize({":version": counted["version"]})
+            else:
+                put["ConditionExpression"] = "attribute_not_exists(version)"
+            transact_items.append({"Put": put})
+
+            for key in get_rollup_keys(item["tenant_id"], item["date"]):
+                rollup = rollups.setdefault(key, dict.fromkeys(COST_METRICS, Decimal(0)))
+                for metric in COST_METRICS:
+                    rollup[metric] += deltas[metric]
+
+        if not transact_items:
+            return 0
+
+        transact_items.extend(
+            _get_rollup_update(table_name, tenant_id, sk, deltas) for (tenant_id, sk), deltas in rollups.items()
+        )
+
+        try:
+            dynamodb_client.transact_write_items(TransactItems=transact_items)
+            return len(rollups)
+        except dynamodb_client.exceptions.TransactionCanceledException:
+            # a daily item changed since it was read or a concurrent transaction updated the same rollup
+            if attempt == write_max_attempts - 1:
+                raise
+
+            time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+
+def _get_item_add(table_name, item):
+    values = {
+        ":date": item["date"],
+        ":model_id": item["model_id"],
+        **{f":{metric}": item.get(metric, Decimal(0)) for metric in COST_METRICS}
+    }
+    additions = [f"{metric} :{metric}" for metric in COST_METRICS]
+
+    # the rollups are updated in the same transaction, the version marks the item as counted in them
+    if cost_rollups:
+        values[":one"] = 1
+        additions.append("version :one")
+
+    return {
+        "Update": {
+            "TableName": table_name,
+            "Key": _serialize({"tenant_id": item["tenant_id"], "sk": item["sk"]}),
+            "UpdateExpression": "SET #date = :date, model_id = :model_id ADD " + ", ".join(additions),
+            "ExpressionAttributeNames": {"#date": "date"},
+            "ExpressionAttributeValues": _serialize(values)
+        }
+    }
+
+def _add_transaction(dynamodb_client, table_name, items):
+    """
+    Adds the metrics of the daily items and, with COST_ROLLUPS, of their rollups in one transaction
+    """
+    transact_items = [_get_item_add(table_name, item) for item in items]
+
+    if cost_rollups:
+        rollups = {}
+        for item in items:
+            for key in get_rollup_keys(item["tenant_id"], item["date"]):
+                rollup = rollups.setdefault(key, dict.fromkeys(COST_METRICS, Decimal(0)))
+                for metric in COST_METRICS:
+                    rollup[metric] += item.get(metric, Decimal(0))
+
+        transact_items.extend(
+            _get_rollup_update(table_name, tenant_id, sk, deltas) for (tenant_id, sk), deltas in rollups.items()
+        )
+
+    for attempt in range(write_max_attempts):
+        try:
+            dynamodb_client.transact_write_items(TransactItems=transact_items)
+            return
+        except dynamodb_client.exceptions.TransactionCanceledException:
+            # a canceled transaction changed nothing, it conflicted with a concurrent update of the same items
+            if attempt == write_max_attempts - 1:
+                raise
+
+            time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+
+def add_cost_items(df, table_name, dynamodb_client=None):
+    """
+    Adds the metrics of the tenant_id, model_id, date rows to the stored cost items with atomic ADD updates, so
+    concurrent runs can add to the same item. Returns the new totals of the rows as a dataframe.
+    """
+    dynamodb_client = dynamodb_client or boto3.client("dynamodb")
+
+    items = [_get_cost_item(row) for row in df.to_dict("records")]
+    items.sort(key=lambda item: (item["tenant_id"], item["sk"]))
+
+    start_time = time.perf_counter()
+    chunks = [items[i:i + TRANSACTION_CHUNK_SIZE] for i in range(0, len(items), TRANSACTION_CHUNK_SIZE)]
+    for chunk in chunks:
+        _add_transaction(dynamodb_client, table_name, chunk)
+    logger.info(f"Added {len(items)} cost items in {len(chunks)} transactions, {time.perf_counter() - start_time:.2f}s")
+
+    if items:
+        bump_aggregation_version(dynamodb_client, table_name)
+
+    current = {}
+    for i in range(0, len(items), BATCH_GET_SIZE):
+        current.update(_read_cost_items(dynamodb_client, table_name, items[i:i + BATCH_GET_SIZE]))
+
+    rows = [
+        {
+            "tenant_id": item["tenant_id"],
+            "model_id": item["model_id"],
+            "date": item["date"],
+            **{
+                metric: float(item.get(metric, 0)) if metric.endswith("_cost") else int(item.get(metric, 0))
+                for metric in COST_METRICS
+            }
+        }
+        for item in current.values()
+    ]
+
+    return pd.DataFrame(rows, columns=["tenant_id", "model_id", "date"] + COST_METRICS)
+
+def read_day_cost_items(date, table_name, dynamodb_client=None):
+    """
+    Daily cost items of all tenants for the date from the date-index, as tenant_id, model_id, date rows
+    """
+    dynamodb_client = dynamodb_client or boto3.client("dynamodb")
+
+    rows = []
+    paginator = dynamodb_client.get_paginator("query")
+    pages = paginator.paginate(
+        TableName=table_name,
+        IndexName="date-index",
+        KeyConditionExpression="#date = :date",
+        ExpressionAttributeNames={"#date": "date"},
+        ExpressionAttributeValues=_serialize({":date": date})
+    )
+    for page in pages:
+        for item in page["Items"]:
+            item = {key: _deserializer.deserialize(value) for key, value in item.items()}
+            rows.append({
+                "tenant_id": item["tenant_id"],
+                "model_id": item["model_id"],
+                "date": item["date"],
+                **{
+                    metric: float(item.get(metric, 0)) if metric.endswith("_cost") else int(item.get(metric, 0))
+                    for metric in COST_METRICS
+                }
+            })
+
+    return pd.DataFrame(rows, columns=["tenant_id", "model_id", "date"] + COST_METRICS)
+
+def bump_aggregation_version(dynamodb_client, table_name):
+    dynamodb_client.update_item(
+        TableName=table_name,
+        Key=_serialize(AGGREGATION_VERSION_KEY),
+        UpdateExpression="SET updated_at = :updated_at ADD version :one",
+        ExpressionAttributeValues=_serialize({
+            ":updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            ":one": 1
+        })
+    )
+
+def write_cost_items(df, table_name, dynamodb_client=None):
+    """
+    Writes the tenant_id, model_id, date rows of the dataframe to the cost table. Rows of the same tenant, day
+    and model are replaced.
+
+    With COST_ROLLUPS the month, week and day rollups are kept in step, the transactions run one after the other
+    because they all update the day rollup. Otherwise the items are written in BatchWriteItem chunks with
+    WRITE_MAX_CONCURRENCY chunks in flight.
+    """
+    dynamodb_client = dynamodb_client or boto3.client("dynamodb")
+
+    items = [_get_cost_item(row) for row in df.to_dict("records")]
+
+    start_time = time.perf_counter()
+    if cost_rollups:
+        items.sort(key=lambda item: (item["tenant_id"], item["sk"]))
+        chunks = [items[i:i + TRANSACTION_CHUNK_SIZE] for i in range(0, len(items), TRANSACTION_CHUNK_SIZE)]
+
+        rollups = sum(_write_transaction(dynamodb_client, table_name, chunk) for chunk in chunks)
+        logger.info(f"Wrote {len(items)} cost items in {len(chunks)} transactions with {rollups} rollup updates, {time.perf_counter() - start_time:.2f}s")
+
+        # every changed item updates its rollups, no rollup update means the table is unchanged
+        if rollups > 0:
+            bump_aggregation_version(dynamodb_client, table_name)
+    else:
+        batches = [items[i:i + BATCH_WRITE_SIZE] for i in range(0, len(items), BATCH_WRITE_SIZE)]
+
+        with ThreadPoolExecutor(max_workers=write_max_concurrency) as executor:
+            # consuming the results re-raises the first failed batch
+            list(executor.map(lambda batch: _write_batch(dynamodb_client, table_name, batch), batches))
+
+        logger.info(f"Wrote {len(items)} cost items in {len(batches)} batches, {time.perf_counter() - start_time:.2f}s")
+
+        if items:
+            bump_aggregation_version(dynamodb_client, table_name)
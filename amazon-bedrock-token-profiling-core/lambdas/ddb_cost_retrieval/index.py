@@ -1,18 +1,381 @@
+import base64
 import json
 import boto3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+from decimal import Decimal
+import hashlib
+import logging
 import os
-from boto3.dynamodb.conditions import Key, Attr
+import threading
+import time
+import traceback
+from boto3.dynamodb.conditions import Attr, Key
+
+logger = logging.getLogger(__name__)
+if len(logging.getLogger().handlers) > 0:
+    logging.getLogger().setLevel(logging.INFO)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+ddb_table = os.environ.get("COST_TABLE_NAME","saas-bedrock-cost-records")
+admin_groups = set(filter(None, os.environ.get("ADMIN_GROUPS", "admin").split(",")))
+query_max_concurrency = int(os.environ.get("QUERY_MAX_CONCURRENCY", 8))
+cache_ttl = int(os.environ.get("CACHE_TTL", 300))
+cache_max_entries = int(os.environ.get("CACHE_MAX_ENTRIES", 256))
+version_check_interval = int(os.environ.get("VERSION_CHECK_INTERVAL", 10))
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+MAX_DAYS = 366
+
+DATE_INDEX = "date-index"
+ROLLUP_ALL_TENANTS = "#all"
+ROLLUP_PERIODS = {"month": "%Y-%m", "week": "%G-W%V", "day": "%Y-%m-%d"}
+KEY_FIELDS = ["tenant_id", "sk", "date"]
+FIELDS = [
+    "tenant_id", "date", "model_id", "input_tokens", "output_tokens",
+    "input_cost", "output_cost", "saved_cost", "invocations", "unpriced_invocations"
+]
+ROLLUP_FIELDS = ["tenant_id", "rollup", "period"] + FIELDS[3:]
+
+# bumped by the cost jobs after every write to the cost table
+AGGREGATION_VERSION_KEY = {"tenant_id": "#meta", "sk": "aggregation_version"}
+
+# boto3 resources are not thread safe, every worker of the long lived pool gets its own table
+local = threading.local()
+executor = ThreadPoolExecutor(max_workers=query_max_concurrency)
+
+# serialized responses of this warm instance, cache key -> (aggregation version, expiry, body, etag)
+cache = OrderedDict()
+aggregation_version = {"value": None, "checked": 0}
+
+
+def _get_table():
+    if not hasattr(local, "table"):
+        local.table = boto3.session.Session().resource('dynamodb').Table(ddb_table)
+
+    return local.table
+
+
+class RequestError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _get_caller(event):
+    claims = event.get("requestContext", {}).get("authorizer", {}).get("claims")
+    if not claims or "cognito:username" not in claims:
+        raise RequestError(403, "Missing caller identity")
+
+    # only group membership grants admin, it is set by the user pool administrators and not by the users
+    groups = set(filter(None, claims.get("cognito:groups", "").replace(",", " ").split()))
+    is_admin = bool(groups & admin_groups)
+
+    return claims["cognito:username"], is_admin
+
+
+def _get_dates(start_date, end_date):
+    try:
+        start = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+        end = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise RequestError(400, "start_date and end_date must be YYYY-MM-DD")
+
+    days = (end - start).days + 1
+    if days < 1 or days > MAX_DAYS:
+        raise RequestError(400, f"The date range must cover 1 to {MAX_DAYS} days")
+
+    return [(start + datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+
+
+def _get_params(body, tenant_id, is_admin):
+    today = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+
+    # tenants only see their own records, admins pick a tenant or get all of them
+    requested_tenant = body.get("tenant_id")
+    if not is_admin:
+        if requested_tenant not in (None, tenant_id):
+            raise RequestError(403, "Access to other tenants is not allowed")
+        requested_tenant = tenant_id
+
+    model_ids = body.get("model_ids") or ([body["model_id"]] if body.get("model_id") else [])
+    fields = [field for field in body.get("fields", FIELDS) if field in FIELDS]
+
+    try:
+        limit = min(max(int(body.get("limit", DEFAULT_LIMIT)), 1), MAX_LIMIT)
+    except (TypeError, ValueError):
+        raise RequestError(400, "limit must be a number")
+
+    start_date = body.get("start_date", body.get("date", today))
+    end_date = body.get("end_date", start_date)
 
-ddb_table = os.environ.get("TABLE_NAME","saas-bedrock-cost-tracking")
-def lambda_handler(event, context):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(ddb_table)
-    response = table.scan()
-    print(response)
     return {
-        'statusCode': 200,
-        'headers': {
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({"body": response['Items']}) 
+        "tenant_id": requested_tenant,
+        "dates": _get_dates(start_date, end_date),
+        "model_ids": sorted(set(model_ids)),
+        "fields": fields or FIELDS,
+        "limit": limit
     }
+
+
+def _get_query_hash(params):
+    query = [params["tenant_id"], params["dates"][0], params["dates"][-1], params["model_ids"]]
+
+    return hashlib.sha256(json.dumps(query).encode("utf-8")).hexdigest()[:16]
+
+
+def encode_cursor(params, key):
+    cursor = {"q": _get_query_hash(params), "key": key}
+
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(params, cursor):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+    except (ValueError, AttributeError):
+        raise RequestError(400, "Invalid cursor")
+
+    # a cursor only continues the query it was issued for
+    if cursor.get("q") != _get_query_hash(params):
+        raise RequestError(400, "The cursor does not belong to this query")
+
+    return cursor["key"]
+
+
+def _get_query_kwargs(params):
+    names = {f"#f{i}": field for i, field in enumerate(sorted(set(params["fields"]) | set(KEY_FIELDS)))}
+    kwargs = {
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names
+    }
+
+    if params["model_ids"]:
+        kwargs["FilterExpression"] = Attr("model_id").is_in(params["model_ids"])
+
+    return kwargs
+
+
+def _query(kwargs, limit, exclusive_start_key=None):
+    """
+    Returns up to limit items in key order, following LastEvaluatedKey while the filter leaves pages short
+    """
+    items = []
+    if exclusive_start_key:
+        kwargs = {**kwargs, "ExclusiveStartKey": exclusive_start_key}
+
+    while len(items) < limit:
+        response = _get_table().query(**kwargs, Limit=limit - len(items))
+        items.extend(response["Items"])
+
+        if "LastEvaluatedKey" not in response:
+            return items, False
+        kwargs = {**kwargs, "ExclusiveStartKey": response["LastEvaluatedKey"]}
+
+    return items, True
+
+
+def query_tenant(params, cursor_key=None):
+    dates = params["dates"]
+    if len(dates) == 1 and len(params["model_ids"]) == 1:
+        key_condition = Key("tenant_id").eq(params["tenant_id"]) & Key("sk").eq(f"{dates[0]}#{params['model_ids'][0]}")
+    else:
+        # "~" sorts after every character used in model ids, the range covers all models of the last day
+        key_condition = Key("tenant_id").eq(params["tenant_id"]) & Key("sk").between(f"{dates[0]}#", f"{dates[-1]}#~")
+
+    kwargs = {"KeyConditionExpression": key_condition, **_get_query_kwargs(params)}
+    items, has_more = _query(kwargs, params["limit"], cursor_key)
+
+    next_key = {"tenant_id": items[-1]["tenant_id"], "sk": items[-1]["sk"]} if has_more and items else None
+
+    return items, next_key
+
+
+def query_all_tenants(params, cursor_key=None):
+    """
+    Queries the date index, days are queried in parallel and returned in date order
+    """
+    limit = params["limit"]
+    dates = params["dates"]
+    if cursor_key:
+        dates = [date for date in dates if date >= cursor_key["date"]]
+
+    def query_date(date):
+        kwargs = {"IndexName": DATE_INDEX, "KeyConditionExpression": Key("date").eq(date), **_get_query_kwargs(params)}
+        start_key = cursor_key if cursor_key and cursor_key["date"] == date else None
+        return _query(kwargs, limit, start_key)
+
+    items = []
+    next_key = None
+
+    # one window of days at a time so a small page does not read the whole range
+    for window_start in range(0, len(dates), query_max_concurrency):
+        window = dates[window_start:window_start + query_max_concurrency]
+
+        for index, (date_items, has_more) in enumerate(executor.map(query_date, window)):
+            remaining = limit - len(items)
+            items.extend(date_items[:remaining])
+
+            if len(items) == limit:
+                is_last_date = window_start + index == len(dates) - 1
+                if len(date_items) > remaining or has_more or not is_last_date:
+                    last = items[-1]
+                    next_key = {"date": last["date"], "tenant_id": last["tenant_id"], "sk": last["sk"]}
+                return items, next_key
+
+    return items, next_key
+
+
+def get_rollup(body, tenant_id, is_admin):
+    """
+    Reads one pre-aggregated rollup: tenant x month, tenant x ISO week or all tenants x day
+    """
+    rollup = body["rollup"]
+    if rollup not in ROLLUP_PERIODS:
+        raise RequestError(400, f"rollup must be one of {', '.join(ROLLUP_PERIODS)}")
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    period = body.get("period") or now.strftime(ROLLUP_PERIODS[rollup])
+
+    if rollup == "day":
+        if not is_admin:
+            raise RequestError(403, "The daily rollup covers all tenants")
+        rollup_tenant = ROLLUP_ALL_TENANTS
+    else:
+        rollup_tenant = body.get("tenant_id", tenant_id) if is_admin else tenant_id
+        if body.get("tenant_id") not in (None, rollup_tenant):
+            raise RequestError(403, "Access to other tenants is not allowed")
+
+    response = _get_table().get_item(Key={"tenant_id": rollup_tenant, "sk": f"{rollup}#{period}"})
+    item = response.get("Item")
+
+    return {
+        "body": [_to_response_item(item, ROLLUP_FIELDS)] if item else [],
+        "cursor": None
+    }
+
+
+def _to_response_item(item, fields):
+    response_item = {
+        key: str(value) if isinstance(value, Decimal) else value
+        for key, value in item.items()
+        if key in fields
+    }
+    # the web UI reads the tenant from "name"
+    response_item["name"] = item["tenant_id"]
+
+    return response_item
+
+
+def get_costs(body, tenant_id, is_admin):
+    if body.get("rollup"):
+        return get_rollup(body, tenant_id, is_admin)
+
+    params = _get_params(body, tenant_id, is_admin)
+    cursor_key = decode_cursor(params, body["cursor"]) if body.get("cursor") else None
+
+    if params["tenant_id"] is not None:
+        items, next_key = query_tenant(params, cursor_key)
+    else:
+        items, next_key = query_all_tenants(params, cursor_key)
+
+    return {
+        "body": [_to_response_item(item, params["fields"]) for item in items],
+        "cursor": encode_cursor(params, next_key) if next_key else None
+    }
+
+
+def get_aggregation_version():
+    """
+    Version of the cost table content, read at most every VERSION_CHECK_INTERVAL seconds
+    """
+    now = time.monotonic()
+    if aggregation_version["value"] is None or now - aggregation_version["checked"] >= version_check_interval:
+        item = _get_table().get_item(Key=AGGREGATION_VERSION_KEY, ProjectionExpression="version").get("Item", {})
+        aggregation_version["value"] = str(item.get("version", 0))
+        aggregation_version["checked"] = now
+
+    return aggregation_version["value"]
+
+
+def _get_cache_key(body, tenant_id, is_admin):
+    # the same body means different records for different tenants, and the default range moves with the day
+    today = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+    scope = "#admin" if is_admin else tenant_id
+
+    return hashlib.sha256(json.dumps([scope, today, body], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get_response(event):
+    """
+    Returns the serialized response and its ETag, from the cache while the cost table has not changed
+    """
+    tenant_id, is_admin = _get_caller(event)
+
+    try:
+        body = json.loads(event.get("body") or "{}")
+    except ValueError:
+        raise RequestError(400, "The body must be JSON")
+
+    if not isinstance(body, dict):
+        raise RequestError(400, "The body must be a JSON object")
+
+    version = get_aggregation_version()
+    key = _get_cache_key(body, tenant_id, is_admin)
+
+    entry = cache.get(key)
+    if entry is not None and entry[0] == version and entry[1] > time.monotonic():
+        cache.move_to_end(key)
+        return entry[2], entry[3]
+
+    response_body = json.dumps(get_costs(body, tenant_id, is_admin))
+    etag = '"' + hashlib.sha256(response_body.encode("utf-8")).hexdigest()[:32] + '"'
+
+    if cache_ttl > 0:
+        cache[key] = (version, time.monotonic() + cache_ttl, response_body, etag)
+        cache.move_to_end(key)
+        while len(cache) > cache_max_entries:
+            cache.popitem(last=False)
+
+    return response_body, etag
+
+
+def _get_if_none_match(event):
+    headers = {key.lower(): value for key, value in (event.get("headers") or {}).items()}
+
+    return {tag.strip().removeprefix("W/") for tag in headers.get("if-none-match", "").split(",") if tag.strip()}
+
+
+def lambda_handler(event, context):
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag'
+    }
+
+    try:
+        response_body, etag = get_response(event)
+        headers = {**headers, 'ETag': etag, 'Cache-Control': 'no-cache'}
+
+        # the ETag is a hash of the body, a client holding the same body gets an empty 304
+        if etag in _get_if_none_match(event):
+            return {'statusCode': 304, 'headers': headers, 'body': ''}
+
+        return {
+            'statusCode': 200,
+            'headers': headers,
+            'body': response_body
+        }
+    except RequestError as e:
+        return {
+            'statusCode': e.status_code,
+            'headers': headers,
+            'body': json.dumps({"error": str(e)})
+        }
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        logger.error(stacktrace)
+
+        return {"statusCode": 500, "body": str(e)}
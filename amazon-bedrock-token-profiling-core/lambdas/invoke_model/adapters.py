@@ -0,0 +1,164 @@
+import json
+
+INPUT_TOKENS_HEADER = "x-amzn-bedrock-input-token-count"
+OUTPUT_TOKENS_HEADER = "x-amzn-bedrock-output-token-count"
+
+
+class ProviderAdapter:
+    """
+    Translates between the API request/response and the model specific Bedrock payload
+    """
+
+    def prepare_input(self, prompt, model_kwargs, streaming=False):
+        return {"prompt": prompt, **model_kwargs}
+
+    def get_text(self, body):
+        raise NotImplementedError
+
+    def get_usage(self, body):
+        return None, None
+
+    def get_chunk_text(self, chunk):
+        raise ValueError(f"Streaming is not supported for provider {type(self).__name__}")
+
+
+class AnthropicAdapter(ProviderAdapter):
+    # the Messages API rejects unknown keys, the API parameters are mapped to its names and the others dropped
+    PARAMETERS = {
+        "maxTokenCount": "max_tokens",
+        "max_tokens": "max_tokens",
+        "temperature": "temperature",
+        "topP": "top_p",
+        "top_p": "top_p",
+        "top_k": "top_k",
+        "stopSequences": "stop_sequences",
+        "stop_sequences": "stop_sequences",
+    }
+
+    def prepare_input(self, prompt, model_kwargs, streaming=False):
+        return {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": 1000,
+            **{self.PARAMETERS[key]: value for key, value in model_kwargs.items() if key in self.PARAMETERS},
+            "messages": [{
+                "role": "user",
+                "content": [{"type": "text", "text": prompt}]
+            }]
+        }
+
+    def get_text(self, body):
+        return "".join(block.get("text", "") for block in body.get("content", []))
+
+    def get_usage(self, body):
+        usage = body.get("usage", {})
+        return usage.get("input_tokens"), usage.get("output_tokens")
+
+    def get_chunk_text(self, chunk):
+        if chunk.get("type") == "content_block_delta":
+            return chunk["delta"].get("text", "")
+        return ""
+
+
+class AmazonAdapter(ProviderAdapter):
+    def prepare_input(self, prompt, model_kwargs, streaming=False):
+        return {"inputText": prompt, "textGenerationConfig": {**model_kwargs}}
+
+    def get_text(self, body):
+        return body["results"][0]["outputText"]
+
+    def get_usage(self, body):
+        return body.get("inputTextTokenCount"), body["results"][0].get("tokenCount")
+
+    def get_chunk_text(self, chunk):
+        return chunk.get("outputText", "")
+
+
+class AI21Adapter(ProviderAdapter):
+    def get_text(self, body):
+        return body["completions"][0]["data"]["text"]
+
+    def get_usage(self, body):
+        input_tokens = len(body.get("prompt", {}).get("tokens", [])) or None
+        output_tokens = len(body["completions"][0]["data"].get("tokens", [])) or None
+        return input_tokens, output_tokens
+
+
+class CohereAdapter(ProviderAdapter):
+    def prepare_input(self, prompt, model_kwargs, streaming=False):
+        request_body = {"prompt": prompt, **model_kwargs}
+        if streaming:
+            request_body["stream"] = True
+        return request_body
+
+    def get_text(self, body):
+        return body["generations"][0]["text"]
+
+    def get_chunk_text(self, chunk):
+        return chunk.get("text", "")
+
+
+class MetaAdapter(ProviderAdapter):
+    def get_text(self, body):
+        return body["generation"]
+
+    def get_usage(self, body):
+        return body.get("prompt_token_count"), body.get("generation_token_count")
+
+    def get_chunk_text(self, chunk):
+        return chunk.get("generation", "")
+
+
+class MistralAdapter(ProviderAdapter):
+    def get_text(self, body):
+        return body["outputs"][0]["text"]
+
+    def get_chunk_text(self, chunk):
+        outputs = chunk.get("outputs", [])
+        return outputs[0].get("text", "") if outputs else ""
+
+
+ADAPTERS = {
+    "anthropic": AnthropicAdapter(),
+    "amazon": AmazonAdapter(),
+    "ai21": AI21Adapter(),
+    "cohere": CohereAdapter(),
+    "meta": MetaAdapter(),
+    "mistral": MistralAdapter(),
+}
+
+
+def get_adapter(provider):
+    if provider not in ADAPTERS:
+        raise ValueError(f"Provider {provider} is not supported")
+
+    return ADAPTERS[provider]
+
+
+def prepare_input(provider, prompt, model_kwargs, streaming=False):
+    return get_adapter(provider).prepare_input(prompt, model_kwargs, streaming=streaming)
+
+
+def prepare_output(provider, response):
+    adapter = get_adapter(provider)
+    body = json.loads(response["body"].read())
+
+    input_tokens, output_tokens = adapter.get_usage(body)
+
+    # Bedrock reports the billed token counts in the response headers for every provider
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    if INPUT_TOKENS_HEADER in headers:
+        input_tokens = int(headers[INPUT_TOKENS_HEADER])
+    if OUTPUT_TOKENS_HEADER in headers:
+        output_tokens = int(headers[OUTPUT_TOKENS_HEADER])
+
+    return {
+        "text": adapter.get_text(body),
+        "usage": {
+            "prompt_tokens": input_tokens or 0,
+            "completion_tokens": output_tokens or 0
+        }
+    }
+
+
+def get_chunk_text(provider, chunk):
+    return get_adapter(provider).get_chunk_text(chunk)
@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+if len(logging.getLogger().handlers) > 0:
+    logging.getLogger().setLevel(logging.INFO)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+RECORD_TYPE = "budget"
+
+
+class TokenBudgets:
+    """
+    Per tenant token budgets stored as budget#<tenant_id> items with a numeric remaining_tokens attribute.
+
+    Tenants without a budget item are not limited. Lookups are cached in memory for cache_ttl seconds.
+    """
+
+    def __init__(self, table, cache_ttl=30):
+        self.table = table
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
+        self.cache = {}
+
+        # the table resource is not thread safe, its client is and converts the attribute values like the table
+        self.client = table.meta.client
+
+    @staticmethod
+    def get_key(tenant_id):
+        return f"{RECORD_TYPE}#{tenant_id}"
+
+    def get_remaining_tokens(self, tenant_id):
+        with self.lock:
+            cached = self.cache.get(tenant_id)
+
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+
+        response = self.client.get_item(
+            TableName=self.table.name,
+            Key={"pk": self.get_key(tenant_id)},
+            ProjectionExpression="remaining_tokens"
+        )
+        remaining_tokens = response.get("Item", {}).get("remaining_tokens")
+        if remaining_tokens is not None:
+            remaining_tokens = int(remaining_tokens)
+
+        self._set_cache(tenant_id, remaining_tokens)
+
+        return remaining_tokens
+
+    def has_budget(self, tenant_id, estimated_tokens):
+        remaining_tokens = self.get_remaining_tokens(tenant_id)
+
+        return remaining_tokens is None or remaining_tokens >= estimated_tokens
+
+    def consume(self, tenant_id, tokens):
+        if tokens <= 0 or self.get_remaining_tokens(tenant_id) is None:
+            return
+
+        try:
+            response = self.client.update_item(
+                TableName=self.table.name,
+                Key={"pk": self.get_key(tenant_id)},
+                UpdateExpression="ADD remaining_tokens :tokens",
+                ConditionExpression="attribute_exists(remaining_tokens)",
+                ExpressionAttributeValues={":tokens": -tokens},
+                ReturnValues="UPDATED_NEW"
+            )
+            self._set_cache(tenant_id, int(response["Attributes"]["remaining_tokens"]))
+        except self.client.exceptions.ConditionalCheckFailedException:
+            # the budget was removed since it was cached
+            self._set_cache(tenant_id, None)
+
+    def _set_cache(self, tenant_id, remaining_tokens):
+        with self.lock:
+            self.cache[tenant_id] = (remaining_tokens, time.monotonic() + self.cache_ttl)
@@ -1,12 +1,19 @@
+from adapters import get_chunk_text, prepare_input, prepare_output
 from aws_lambda_powertools import Logger
 import boto3
 from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+import datetime
 import json
-from langchain_community.llms.bedrock import LLMInputOutputAdapter
 import logging
-import math
 import os
+import threading
+import time
 import traceback
+from budgets import TokenBudgets
+from response_cache import ResponseCache
+from token_counter import count_tokens
+from usage_counters import UsageCounters
 
 logger = logging.getLogger(__name__)
 if len(logging.getLogger().handlers) > 0:
@@ -25,6 +32,48 @@ bedrock_url = os.environ.get("BEDROCK_URL", None)
 iam_role = os.environ.get("IAM_ROLE", None)
 table_name = os.environ.get("TABLE_NAME", None)
 s3_bucket = os.environ.get("S3_BUCKET", None)
+credentials_refresh_margin = int(os.environ.get("CREDENTIALS_REFRESH_MARGIN", 300))
+usage_flush_interval = int(os.environ.get("USAGE_FLUSH_INTERVAL", 5))
+usage_max_pending = int(os.environ.get("USAGE_MAX_PENDING", 100))
+usage_flush_concurrency = int(os.environ.get("USAGE_FLUSH_CONCURRENCY", 8))
+budget_cache_ttl = int(os.environ.get("BUDGET_CACHE_TTL", 30))
+response_cache_enabled = os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+response_cache_size = int(os.environ.get("RESPONSE_CACHE_SIZE", 256))
+response_cache_ttl = int(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+batch_max_items = int(os.environ.get("BATCH_MAX_ITEMS", 50))
+batch_max_concurrency = int(os.environ.get("BATCH_MAX_CONCURRENCY", 4))
+batch_model_concurrency = json.loads(os.environ.get("BATCH_MODEL_CONCURRENCY", "{}"))
+
+# Bedrock client reused across warm invocations, rebuilt when assumed-role credentials are about to expire
+_bedrock_client_lock = threading.Lock()
+_bedrock_client_cache = {"client": None, "expiration": None}
+_bedrock_client_stats = {"hits": 0, "misses": 0}
+
+usage_counters = None
+token_budgets = None
+if table_name is not None:
+    usage_counters = UsageCounters(
+        table=dynamodb.Table(table_name),
+        flush_interval=usage_flush_interval,
+        max_pending=usage_max_pending,
+        max_concurrency=usage_flush_concurrency
+    )
+    token_budgets = TokenBudgets(
+        table=dynamodb.Table(table_name),
+        cache_ttl=budget_cache_ttl
+    )
+
+response_cache = None
+if response_cache_enabled:
+    response_cache = ResponseCache(
+        table=dynamodb.Table(table_name) if table_name is not None else None,
+        max_size=response_cache_size,
+        ttl=response_cache_ttl
+    )
+
+
+def _elapsed_ms(start_time):
+    return round((time.perf_counter() - start_time) * 1000, 2)
 
 
 class BedrockInference:
@@ -35,6 +84,8 @@ class BedrockInference:
         self.messages_api = messages_api
         self.input_tokens = 0
         self.output_tokens = 0
+        self.first_token_latency = None
+        self.timings = {}
 
     def get_input_tokens(self):
         return self.input_tokens
@@ -42,6 +93,21 @@ class BedrockInference:
     def get_output_tokens(self):
         return self.output_tokens
 
+    def get_first_token_latency(self):
+        return self.first_token_latency
+
+    def get_timings(self):
+        return self.timings
+
+    def prepare_body(self, provider, body, model_kwargs, streaming=False):
+        request_body = prepare_input(
+            provider=provider,
+            prompt=body["inputs"],
+            model_kwargs=model_kwargs,
+            streaming=streaming)
+
+        return json.dumps(request_body)
+
     def invoke_text(self, body, model_kwargs):
         try:
             provider = self.model_id.split(".")[0]
@@ -50,36 +116,24 @@ class BedrockInference:
             modelId = self.model_arn if self.model_arn is not None else self.model_id
             print("modelId:", modelId)
 
-            if(provider=="anthropic"):
-                response = self.bedrock_client.invoke_model(
-                    modelId=modelId,
-                    body=json.dumps(
-                        {
-                            "anthropic_version": "bedrock-2023-05-31",    
-                            "max_tokens": 1000,
-                            "messages": [{
-                                    "role": "user",
-                                    "content": [{ "type": "text", "text": body["inputs"]}]
-                                    
-                                }]
-                        }),
-                )
-            else:
-                request_body = LLMInputOutputAdapter.prepare_input(
-                    provider=provider,
-                    prompt=body["inputs"],
-                    model_kwargs=model_kwargs)
-                request_body = json.dumps(request_body)
-                print("request_body:", request_body)
-                response = self.bedrock_client.invoke_model(
-                    body=request_body,
-                    modelId=modelId,
-                    accept="application/json",
-                    contentType="application/json"
-                )
+            start_time = time.perf_counter()
+            request_body = self.prepare_body(provider, body, model_kwargs)
+            self.timings["serialize"] = _elapsed_ms(start_time)
+            print("request_body:", request_body)
+
+            start_time = time.perf_counter()
+            response = self.bedrock_client.invoke_model(
+                body=request_body,
+                modelId=modelId,
+                accept="application/json",
+                contentType="application/json"
+            )
+            self.timings["bedrock"] = _elapsed_ms(start_time)
             print("response:", response)
 
-            response = LLMInputOutputAdapter.prepare_output(provider, response)
+            start_time = time.perf_counter()
+            response = prepare_output(provider, response)
+            self.timings["parse"] = _elapsed_ms(start_time)
             answer = response["text"]
             self.input_tokens = response['usage']['prompt_tokens']
             self.output_tokens = response['usage']['completion_tokens']
@@ -92,9 +146,52 @@ class BedrockInference:
 
             raise e
 
+    def invoke_text_streaming(self, body, model_kwargs):
+        try:
+            provider = self.model_id.split(".")[0]
+            modelId = self.model_arn if self.model_arn is not None else self.model_id
+            logger.debug(f"Streaming invocation, provider: {provider}, modelId: {modelId}")
 
+            start_time = time.perf_counter()
+            request_body = self.prepare_body(provider, body, model_kwargs, streaming=True)
+            self.timings["serialize"] = _elapsed_ms(start_time)
 
-def _get_bedrock_client():
+            start_time = time.perf_counter()
+
+            response = self.bedrock_client.invoke_model_with_response_stream(
+                body=request_body,
+                modelId=modelId,
+                accept="application/json",
+                contentType="application/json"
+            )
+
+            for event in response["body"]:
+                if "chunk" not in event:
+                    continue
+
+                chunk = json.loads(event["chunk"]["bytes"])
+
+                # the last chunk of every provider carries the token usage of the whole invocation
+                metrics = chunk.get("amazon-bedrock-invocationMetrics")
+                if metrics is not None:
+                    self.input_tokens = metrics["inputTokenCount"]
+                    self.output_tokens = metrics["outputTokenCount"]
+
+                text = get_chunk_text(provider, chunk)
+                if text:
+                    if self.first_token_latency is None:
+                        self.first_token_latency = round((time.perf_counter() - start_time) * 1000)
+                    yield text
+
+            self.timings["bedrock"] = _elapsed_ms(start_time)
+        except Exception as e:
+            stacktrace = traceback.format_exc()
+
+            logger.error(stacktrace)
+
+            raise e
+
+def _create_bedrock_client():
     try:
         logger.info(f"Create new client\n  Using region: {bedrock_region}")
         session_kwargs = {"region_name": bedrock_region}
@@ -108,6 +205,7 @@ def _get_bedrock_client():
             },
         )
         session = boto3.Session(**session_kwargs)
+        expiration = None
 
         if iam_role is not None:
             logger.info(f"Using role: {iam_role}")
@@ -123,6 +221,7 @@ def _get_bedrock_client():
                 aws_secret_access_key=response['Credentials']['SecretAccessKey'],
                 aws_session_token=response['Credentials']['SessionToken']
             )
+            expiration = response['Credentials']['Expiration']
 
         if bedrock_url:
             client_kwargs["endpoint_url"] = bedrock_url
@@ -135,7 +234,7 @@ def _get_bedrock_client():
 
         logger.info("boto3 Bedrock client successfully created!")
         logger.info(bedrock_client._endpoint)
-        return bedrock_client
+        return bedrock_client, expiration
 
     except Exception as e:
         stacktrace = traceback.format_exc()
@@ -143,18 +242,108 @@ def _get_bedrock_client():
 
         raise e
 
-def _get_tokens(string):
-    logger.info("Counting approximation tokens")
+def _is_client_valid(expiration):
+    if expiration is None:
+        return True
 
-    return math.floor(len(string) / 4)
+    now = datetime.datetime.now(datetime.timezone.utc)
 
-def bedrock_handler(event):
-    logger.info("Bedrock Endpoint")
+    return (expiration - now).total_seconds() > credentials_refresh_margin
 
-    model_id = event["queryStringParameters"]["model_id"]
-    model_arn = event["queryStringParameters"].get("model_arn")
-    tenant_id = event['requestContext']['authorizer']['claims']['cognito:username']
+def _get_bedrock_client():
+    with _bedrock_client_lock:
+        bedrock_client = _bedrock_client_cache["client"]
+
+        if bedrock_client is not None and _is_client_valid(_bedrock_client_cache["expiration"]):
+            _bedrock_client_stats["hits"] += 1
+        else:
+            _bedrock_client_stats["misses"] += 1
+
+            bedrock_client, expiration = _create_bedrock_client()
+            _bedrock_client_cache["client"] = bedrock_client
+            _bedrock_client_cache["expiration"] = expiration
+
+        logger.info(f"Bedrock client cache: {_bedrock_client_stats}")
+
+        return bedrock_client
+
+def _is_streaming(event):
+    headers = event.get("headers") or {}
+    headers = {k.lower(): v for k, v in headers.items()}
+
+    return str(headers.get("streaming", "false")).lower() == "true"
+
+def _get_cache_control(event):
+    headers = event.get("headers") or {}
+    headers = {k.lower(): v for k, v in headers.items()}
+
+    return str(headers.get("cache-control", "")).lower()
+
+def _get_batch_concurrency(model_id):
+    return int(batch_model_concurrency.get(model_id, batch_max_concurrency))
+
+def _invoke_prompt(tenant_id, request_id, model_id, model_arn, prompt, model_kwargs, streaming=False, cache_control=""):
+    invoke_start_time = time.perf_counter()
+    timings = {}
+
+    # "Cache-Control: no-cache" skips the lookup but refreshes the entry, "no-store" bypasses the cache
+    start_time = time.perf_counter()
+    cache_key = None
+    cached_response = None
+    if response_cache is not None and "no-store" not in cache_control:
+        cache_key = ResponseCache.get_key(model_id, model_arn, prompt, model_kwargs)
+
+        if "no-cache" not in cache_control:
+            cached_response = response_cache.get(cache_key)
+    timings["cache"] = _elapsed_ms(start_time)
+
+    if cached_response is not None:
+        logger.info(f"Response cache hit for request {request_id}")
+
+        start_time = time.perf_counter()
+        if usage_counters is not None:
+            usage_counters.add(
+                tenant_id=tenant_id,
+                model_id=model_id,
+                input_tokens=0,
+                output_tokens=0
+            )
+        timings["bookkeeping"] = _elapsed_ms(start_time)
+        timings["total"] = _elapsed_ms(invoke_start_time)
+
+        logs = {
+            "tenant_id": tenant_id,
+            "requestId": request_id,
+            "region": bedrock_region,
+            "model_id": model_id,
+            "inputTokens": 0,
+            "outputTokens": 0,
+            "cacheHit": True,
+            "savedInputTokens": cached_response["input_tokens"],
+            "savedOutputTokens": cached_response["output_tokens"],
+            "latency": timings["total"],
+            "timings": timings
+        }
+        cloudwatch_logger.info(logs)
+
+        return 200, {
+            "generated_text": cached_response["text"],
+            "inputTokens": 0,
+            "outputTokens": 0,
+            "cacheHit": True
+        }
+
+    start_time = time.perf_counter()
+    estimated_input_tokens = count_tokens(prompt, model_id.split(".")[0])
+
+    if token_budgets is not None and not token_budgets.has_budget(tenant_id, estimated_input_tokens):
+        logger.info(f"Token budget exhausted for tenant {tenant_id}")
+        return 429, {"error": "Token budget exceeded"}
+    timings["budget"] = _elapsed_ms(start_time)
+
+    start_time = time.perf_counter()
     bedrock_client = _get_bedrock_client()
+    timings["client"] = _elapsed_ms(start_time)
 
     bedrock_inference = BedrockInference(
         bedrock_client=bedrock_client,
@@ -163,7 +352,68 @@ def bedrock_handler(event):
         messages_api="false"
     )
 
+    body = {"inputs": prompt}
+
+    if streaming:
+        response = "".join(bedrock_inference.invoke_text_streaming(body, model_kwargs))
+    else:
+        response = bedrock_inference.invoke_text(body, model_kwargs)
+    timings.update(bedrock_inference.get_timings())
+
+    start_time = time.perf_counter()
+    if cache_key is not None:
+        response_cache.put(
+            cache_key,
+            response,
+            bedrock_inference.get_input_tokens(),
+            bedrock_inference.get_output_tokens()
+        )
 
+    if token_budgets is not None:
+        token_budgets.consume(
+            tenant_id,
+            bedrock_inference.get_input_tokens() + bedrock_inference.get_output_tokens()
+        )
+
+    if usage_counters is not None:
+        usage_counters.add(
+            tenant_id=tenant_id,
+            model_id=model_id,
+            input_tokens=bedrock_inference.get_input_tokens(),
+            output_tokens=bedrock_inference.get_output_tokens()
+        )
+    timings["bookkeeping"] = _elapsed_ms(start_time)
+    timings["total"] = _elapsed_ms(invoke_start_time)
+
+    # phase timings are in ms from a monotonic clock, writing this record is the only untimed step
+    logs = {
+        "tenant_id": tenant_id,
+        "requestId": request_id,
+        "region": bedrock_region,
+        "model_id": model_id,
+        "inputTokens": bedrock_inference.get_input_tokens(),
+        "outputTokens": bedrock_inference.get_output_tokens(),
+        "estimatedInputTokens": estimated_input_tokens,
+        "streaming": streaming,
+        "latency": timings["total"],
+        "timings": timings
+    }
+    if streaming:
+        logs["firstTokenLatency"] = bedrock_inference.get_first_token_latency()
+    cloudwatch_logger.info(logs)
+
+    return 200, {
+        "generated_text": response,
+        "inputTokens": bedrock_inference.get_input_tokens(),
+        "outputTokens": bedrock_inference.get_output_tokens()
+    }
+
+def bedrock_handler(event):
+    logger.info("Bedrock Endpoint")
+
+    model_id = event["queryStringParameters"]["model_id"]
+    model_arn = event["queryStringParameters"].get("model_arn")
+    tenant_id = event['requestContext']['authorizer']['claims']['cognito:username']
     request_id = event["requestContext"]["requestId"]
 
     logger.info(f"Model ID: {model_id}")
@@ -172,25 +422,96 @@ def bedrock_handler(event):
     body = json.loads(event["body"])
     model_kwargs = body.get("parameters", {})
 
-    response = bedrock_inference.invoke_text(body, model_kwargs)
-    results = {
+    status_code, result = _invoke_prompt(
+        tenant_id=tenant_id,
+        request_id=request_id,
+        model_id=model_id,
+        model_arn=model_arn,
+        prompt=body["inputs"],
+        model_kwargs=model_kwargs,
+        streaming=_is_streaming(event),
+        cache_control=_get_cache_control(event)
+    )
+
+    if status_code != 200:
+        return {
+            "statusCode": status_code,
+            "headers": {
+                "Access-Control-Allow-Origin": "*"
+            },
+            "body": json.dumps({"message": result["error"]})
+        }
+
+    headers = {
+        "Access-Control-Allow-Origin": "*"
+    }
+    if result.get("cacheHit"):
+        headers["X-Cache"] = "Hit"
+
+    return {
+        "statusCode": 200,
+        "headers": headers,
+        "body": json.dumps([{"generated_text": result["generated_text"]}])
+    }
+
+def batch_handler(event):
+    logger.info("Bedrock Batch Endpoint")
+
+    model_id = event["queryStringParameters"]["model_id"]
+    model_arn = event["queryStringParameters"].get("model_arn")
+    tenant_id = event['requestContext']['authorizer']['claims']['cognito:username']
+    request_id = event["requestContext"]["requestId"]
+
+    body = json.loads(event["body"])
+    prompts = body.get("inputs")
+    model_kwargs = body.get("parameters", {})
+    cache_control = _get_cache_control(event)
+
+    if not isinstance(prompts, list) or len(prompts) == 0 or len(prompts) > batch_max_items:
+        logger.error(f"Bad Request: 'inputs' must be a list of 1 to {batch_max_items} prompts")
+        return {
+            "statusCode": 400,
+            "headers": {
+                "Access-Control-Allow-Origin": "*"
+            },
+            "body": json.dumps({"message": f"'inputs' must be a list of 1 to {batch_max_items} prompts"})
+        }
+
+    logger.info(f"Model ID: {model_id}")
+    logger.info(f"Request ID: {request_id}, batch size: {len(prompts)}")
+
+    def invoke_item(index, prompt):
+        try:
+            # every item is logged as its own usage record with a unique request id
+            status_code, result = _invoke_prompt(
+                tenant_id=tenant_id,
+                request_id=f"{request_id}-{index}",
+                model_id=model_id,
+                model_arn=model_arn,
+                prompt=prompt,
+                model_kwargs=model_kwargs,
+                cache_control=cache_control
+            )
+
+            return result
+        except Exception as e:
+            stacktrace = traceback.format_exc()
+            logger.error(stacktrace)
+
+            return {"error": str(e)}
+
+    max_workers = min(_get_batch_concurrency(model_id), len(prompts))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(invoke_item, range(len(prompts)), prompts))
+
+    return {
         "statusCode": 200,
         "headers": {
             "Access-Control-Allow-Origin": "*"
         },
-        "body": json.dumps([{"generated_text": response}])
-    }
-        
-    logs = {
-        "tenant_id": tenant_id,
-        "requestId": request_id,
-        "region": bedrock_region,
-        "model_id": model_id,
-        "inputTokens": bedrock_inference.get_input_tokens(),
-        "outputTokens": bedrock_inference.get_output_tokens()
+        "body": json.dumps(results)
     }
-    cloudwatch_logger.info(logs)
-    return results
 
 def lambda_handler(event, context):
     logger.info(str(event))
@@ -200,9 +521,16 @@ def lambda_handler(event, context):
             logger.error("Bad Request: Header 'tenant_id' is missing")
             return {"statusCode": 400, "body": "Bad Request"}
 
+        if event.get("resource") == "/invoke_model_batch":
+            return batch_handler(event)
+
         return bedrock_handler(event)
 
     except Exception as e:
         stacktrace = traceback.format_exc()
         logger.error(stacktrace)
         return {"statusCode": 500, "body": json.dumps([{"generated_text": stacktrace}])}
+    finally:
+        # the container is frozen once the handler returns, buffered usage is written before that
+        if usage_counters is not None:
+            usage_counters.flush_if_due()
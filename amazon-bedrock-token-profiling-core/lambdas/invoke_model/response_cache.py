@@ -0,0 +1,114 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+if len(logging.getLogger().handlers) > 0:
+    logging.getLogger().setLevel(logging.INFO)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+RECORD_TYPE = "cache"
+
+
+class ResponseCache:
+    """
+    Exact-match cache of model answers with an in-process LRU tier and a shared DynamoDB tier.
+
+    Entries expire after ttl seconds, the DynamoDB items carry the same expiry in the table's ttl attribute.
+    """
+
+    def __init__(self, table=None, max_size=256, ttl=3600):
+        self.table = table
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+        # the table resource is not thread safe, its client is and converts the attribute values like the table
+        self.client = table.meta.client if table is not None else None
+
+    @staticmethod
+    def get_key(model_id, model_arn, prompt, model_kwargs):
+        payload = json.dumps(
+            {"model_id": model_id, "model_arn": model_arn, "prompt": prompt, "model_kwargs": model_kwargs},
+            sort_keys=True
+        )
+
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry["expires_at"] > now:
+                    self.entries.move_to_end(key)
+                    return entry
+                del self.entries[key]
+
+        if self.table is None:
+            return None
+
+        try:
+            item = self.client.get_item(TableName=self.table.name, Key={"pk": f"{RECORD_TYPE}#{key}"}).get("Item")
+        except Exception:
+            stacktrace = traceback.format_exc()
+            logger.error(stacktrace)
+
+            return None
+
+        # expired items can still be returned until DynamoDB TTL removes them
+        if item is None or int(item["ttl"]) <= now:
+            return None
+
+        entry = {
+            "text": item["text"],
+            "input_tokens": int(item["input_tokens"]),
+            "output_tokens": int(item["output_tokens"]),
+            "expires_at": int(item["ttl"])
+        }
+        self._put_local(key, entry)
+
+        return entry
+
+    def put(self, key, text, input_tokens, output_tokens):
+        entry = {
+            "text": text,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "expires_at": int(time.time()) + self.ttl
+        }
+        self._put_local(key, entry)
+
+        if self.table is None:
+            return
+
+        try:
+            self.client.put_item(
+                TableName=self.table.name,
+                Item={
+                    "pk": f"{RECORD_TYPE}#{key}",
+                    "record_type": RECORD_TYPE,
+                    "text": text,
+                    "input_tokens": input_tokens,
+                    "output_tokens": output_tokens,
+                    "ttl": entry["expires_at"]
+                }
+            )
+        except Exception:
+            stacktrace = traceback.format_exc()
+            logger.error(stacktrace)
+
+    def _put_local(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
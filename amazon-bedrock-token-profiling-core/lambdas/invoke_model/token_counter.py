@@ -0,0 +1,105 @@
+import math
+import re
+import string
+
+# byte tables for the ASCII part of a text, non ASCII characters are counted separately
+_WORD_BYTES = bytes(c if chr(c) in string.ascii_letters else 32 for c in range(256))
+_DIGIT_BYTES = bytes(c if chr(c) in string.digits else 32 for c in range(256))
+_PUNCTUATION_BYTES = string.punctuation.encode("ascii")
+_NEWLINES = re.compile(rb"\n+")
+
+# tokens per word and digit run are looked up by length up to this length, longer runs are computed
+_MAX_TABLE_LENGTH = 64
+
+# Per-provider estimators, no tokenizer vocabulary is needed so counting works offline:
+#   word_chars      - longest word still counted as a single token
+#   subword_chars   - average characters per token for longer words
+#   digit_chars     - digits merged into one token
+#   punctuation_ratio - tokens per punctuation character
+#   non_ascii_ratio - tokens per non ASCII character
+#   scale           - multiplier of the text tokens, fitted to the usage Bedrock reported
+#   overhead        - tokens the prompt template adds to every request
+# meta and mistral are fitted with scripts/fit_token_profiles.py against the Llama 3 and the Mistral 7B/Mixtral
+# tokenizers, the others are heuristics until they are fitted from the logged estimatedInputTokens and inputTokens.
+PROFILES = {
+    "anthropic": {"word_chars": 8, "subword_chars": 4.0, "digit_chars": 3, "punctuation_ratio": 1.0, "non_ascii_ratio": 1.0, "scale": 1.0, "overhead": 7},
+    "amazon": {"word_chars": 6, "subword_chars": 3.5, "digit_chars": 2, "punctuation_ratio": 1.0, "non_ascii_ratio": 1.2, "scale": 1.0, "overhead": 0},
+    "ai21": {"word_chars": 10, "subword_chars": 5.0, "digit_chars": 3, "punctuation_ratio": 1.0, "non_ascii_ratio": 1.0, "scale": 1.0, "overhead": 0},
+    "cohere": {"word_chars": 7, "subword_chars": 4.0, "digit_chars": 3, "punctuation_ratio": 1.0, "non_ascii_ratio": 1.0, "scale": 1.0, "overhead": 0},
+    "meta": {"word_chars": 8, "subword_chars": 7.0, "digit_chars": 1, "punctuation_ratio": 0.5, "non_ascii_ratio": 0.5, "scale": 0.994, "overhead": 1},
+    "mistral": {"word_chars": 12, "subword_chars": 4.5, "digit_chars": 1, "punctuation_ratio": 0.75, "non_ascii_ratio": 0.5, "scale": 1.157, "overhead": 1},
+}
+DEFAULT_PROFILE = {"word_chars": 6, "subword_chars": 4.0, "digit_chars": 3, "punctuation_ratio": 1.0, "non_ascii_ratio": 1.0, "scale": 1.0, "overhead": 0}
+
+
+def get_profile(provider):
+    return PROFILES.get(provider, DEFAULT_PROFILE)
+
+
+class _Counter:
+    """
+    Counts texts with one profile, the tokens of every word and digit run length are looked up in tables built
+    once so the work per text runs in the bytes methods
+    """
+    def __init__(self, word_chars, subword_chars, digit_chars, punctuation_ratio, non_ascii_ratio, scale, overhead):
+        self.word_chars = word_chars
+        self.subword_chars = subword_chars
+        self.digit_chars = digit_chars
+        self.punctuation_ratio = punctuation_ratio
+        self.non_ascii_ratio = non_ascii_ratio
+        self.scale = scale
+        self.overhead = overhead
+        self.word_tokens = [self._get_word_tokens(length) for length in range(_MAX_TABLE_LENGTH + 1)]
+        self.digit_tokens = [self._get_digit_tokens(length) for length in range(_MAX_TABLE_LENGTH + 1)]
+
+    def _get_word_tokens(self, length):
+        return 1 if length <= self.word_chars else math.ceil(length / self.subword_chars)
+
+    def _get_digit_tokens(self, length):
+        return math.ceil(length / self.digit_chars)
+
+    def _sum(self, table, compute, runs):
+        lengths = list(map(len, runs))
+        try:
+            return sum(map(table.__getitem__, lengths))
+        except IndexError:
+            return sum(table[length] if length <= _MAX_TABLE_LENGTH else compute(length) for length in lengths)
+
+    def count(self, text):
+        if not text:
+            return 0
+
+        data = text.encode("ascii", "ignore")
+
+        tokens = self._sum(self.word_tokens, self._get_word_tokens, data.translate(_WORD_BYTES).split())
+        tokens += self._sum(self.digit_tokens, self._get_digit_tokens, data.translate(_DIGIT_BYTES).split())
+        tokens += math.ceil((len(data) - len(data.translate(None, _PUNCTUATION_BYTES))) * self.punctuation_ratio)
+        tokens += len(_NEWLINES.findall(data))
+        tokens += math.ceil((len(text) - len(data)) * self.non_ascii_ratio)
+
+        return self.overhead + math.ceil(tokens * self.scale)
+
+
+_counters = {}
+
+
+def _get_counter(profile):
+    key = tuple(sorted(profile.items()))
+    if key not in _counters:
+        _counters[key] = _Counter(**profile)
+
+    return _counters[key]
+
+
+def count_tokens(text, provider=None):
+    return _get_counter(get_profile(provider)).count(text)
+
+
+def count_tokens_batch(texts, provider=None, profile=None):
+    """
+    Counts every string with the same profile, by default the provider's
+    """
+    counter = _get_counter(profile or get_profile(provider))
+
+    return list(map(counter.count, texts))
+
@@ -0,0 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import logging
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+if len(logging.getLogger().handlers) > 0:
+    logging.getLogger().setLevel(logging.INFO)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+RECORD_TYPE = "usage"
+
+
+class UsageCounters:
+    """
+    Live per tenant/model/hour usage counters kept in DynamoDB.
+
+    Usage is merged in memory and written with atomic ADD updates by flush_if_due, which the handler calls before
+    returning once the buffer is older than flush_interval seconds or holds max_pending keys. The updates are sent
+    concurrently, at most max_concurrency at a time. Usage of the last flush_interval seconds can stay buffered
+    until the next invocation of the same container and is lost if the container is recycled before that, the
+    invocation logs remain the source of truth for billing.
+    """
+
+    def __init__(self, table, flush_interval=5, max_pending=100, ttl_days=35, max_concurrency=8):
+        self.table = table
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.ttl_days = ttl_days
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.monotonic()
+
+        # the table resource is not thread safe, its client is and converts the attribute values like the table
+        self.client = table.meta.client
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    @staticmethod
+    def get_key(tenant_id, model_id, hour):
+        return f"{RECORD_TYPE}#{tenant_id}#{model_id}#{hour}"
+
+    def add(self, tenant_id, model_id, input_tokens, output_tokens, invocations=1):
+        hour = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H")
+
+        with self.lock:
+            counters = self.pending.setdefault(
+                (tenant_id, model_id, hour),
+                {"input_tokens": 0, "output_tokens": 0, "invocations": 0}
+            )
+            counters["input_tokens"] += input_tokens
+            counters["output_tokens"] += output_tokens
+            counters["invocations"] += invocations
+
+    def is_due(self):
+        with self.lock:
+            return len(self.pending) > 0 and (
+                len(self.pending) >= self.max_pending
+                or time.monotonic() - self.last_flush >= self.flush_interval
+            )
+
+    def flush_if_due(self):
+        if self.is_due():
+            self.flush()
+
+    def _update(self, tenant_id, model_id, hour, counters, ttl):
+        values = {
+            ":record_type": RECORD_TYPE,
+            ":tenant_id": tenant_id,
+            ":model_id": model_id,
+            ":hour": hour,
+            ":ttl": ttl,
+            ":input_tokens": counters["input_tokens"],
+            ":output_tokens": counters["output_tokens"],
+            ":invocations": counters["invocations"]
+        }
+
+        self.client.update_item(
+            TableName=self.table.name,
+            Key={"pk": self.get_key(tenant_id, model_id, hour)},
+            UpdateExpression=(
+                "SET record_type = :record_type, tenant_id = :tenant_id, model_id = :model_id, "
+                "#hour = :hour, #ttl = :ttl "
+                "ADD input_tokens :input_tokens, output_tokens :output_tokens, invocations :invocations"
+            ),
+            ExpressionAttributeNames={"#hour": "hour", "#ttl": "ttl"},
+            ExpressionAttributeValues=values
+        )
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+
+        ttl = int(time.time()) + self.ttl_days * 24 * 3600
+
+        futures = {
+            self.executor.submit(self._update, tenant_id, model_id, hour, counters, ttl): (tenant_id, model_id, hour)
+            for (tenant_id, model_id, hour), counters in pending.items()
+        }
+
+        for future, key in futures.items():
+            try:
+                future.result()
+            except Exception:
+                stacktrace = traceback.format_exc()
+                logger.error(stacktrace)
+
+                # keep the counters for the next flush instead of dropping them
+                with self.lock:
+                    current = self.pending.setdefault(
+                        key,
+                        {"input_tokens": 0, "output_tokens": 0, "invocations": 0}
+                    )
+                    for k, v in pending[key].items():
+                        current[k] += v
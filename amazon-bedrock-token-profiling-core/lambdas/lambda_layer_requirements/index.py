@@ -10,6 +10,9 @@ import zipfile
 requirements = os.environ['REQUIREMENTS']
 s3_bucket = os.environ['S3_BUCKET']
 
+# a function and all of its layers must fit in 250 MB unzipped
+MAX_UNZIPPED_SIZE = 250 * 1024 * 1024
+
 
 def upload_file_to_s3(file_path, bucket, key):
     s3 = boto3.client('s3')
@@ -24,6 +27,14 @@ def make_zip_filename():
     return filename
 
 
+def get_dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
 def zipdir(path, zipname):
     zipf = zipfile.ZipFile(zipname, 'w', zipfile.ZIP_DEFLATED)
     for root, dirs, files in os.walk(path):
@@ -60,6 +71,11 @@ def lambda_handler(event, context):
             for requirement in requirements_list:
                 subprocess.check_call([sys.executable, "-m", "pip", "install", requirement, "-t", "python"])
 
+            unzipped_size = get_dir_size("python")
+            print(f"Unzipped layer size: {unzipped_size / 1024 / 1024:.1f} MB")
+            if unzipped_size > MAX_UNZIPPED_SIZE:
+                raise Exception(f"Layer for {requirements} is {unzipped_size / 1024 / 1024:.1f} MB unzipped, over the 250 MB limit")
+
             boto3_zip_name = make_zip_filename()
             zipdir("python", boto3_zip_name)
 
@@ -0,0 +1,301 @@
+import base64
+import boto3
+from boto3.dynamodb.types import TypeSerializer
+from decimal import Decimal
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pandas as pd
+import random
+import time
+import traceback
+from utils import calculate_costs
+
+logger = logging.getLogger(__name__)
+if len(logging.getLogger().handlers) > 0:
+    logging.getLogger().setLevel(logging.INFO)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+table_name = os.environ.get("TABLE_NAME", None)
+usage_ttl_days = int(os.environ.get("USAGE_TTL_DAYS", 35))
+batch_marker_ttl = int(os.environ.get("BATCH_MARKER_TTL", 86400))
+transaction_max_attempts = int(os.environ.get("TRANSACTION_MAX_ATTEMPTS", 5))
+
+RECORD_TYPE = "usage_minute"
+MARKER_RECORD_TYPE = "stream_batch"
+
+METRICS = ["input_tokens", "output_tokens", "input_cost", "output_cost", "saved_cost", "invocations", "unpriced_invocations"]
+
+# a transaction holds at most 100 items, one of them is the batch marker
+TRANSACTION_MAX_UPDATES = 99
+
+# usage log fields as written by the invoke_model function, renamed to the cost tracking columns
+FIELDS = {
+    "tenant_id": "tenant_id",
+    "requestId": "request_id",
+    "region": "region",
+    "model_id": "model_id",
+    "inputTokens": "input_tokens",
+    "outputTokens": "output_tokens",
+    "savedInputTokens": "saved_input_tokens",
+    "savedOutputTokens": "saved_output_tokens",
+    "height": "height",
+    "width": "width",
+    "steps": "steps",
+}
+
+# created on first use, so the local replay runs without AWS credentials or a region
+dynamodb_client = None
+serializer = TypeSerializer()
+
+
+def decode_payload(event):
+    return json.loads(gzip.decompress(base64.b64decode(event["awslogs"]["data"])))
+
+
+def parse_usage_records(payload):
+    """
+    Extracts the usage records from the log events, other log lines of the function are skipped
+    """
+    # a CONTROL_MESSAGE is delivered once to check that the destination is reachable
+    if payload.get("messageType") != "DATA_MESSAGE":
+        return []
+
+    records = []
+
+    for log_event in payload["logEvents"]:
+        try:
+            line = json.loads(log_event["message"])
+        except ValueError:
+            continue
+
+        if not isinstance(line, dict) or line.get("level") != "INFO":
+            continue
+
+        message = line.get("message")
+        if not isinstance(message, dict) or "requestId" not in message or "model_id" not in message:
+            continue
+
+        record = {column: message[field] for field, column in FIELDS.items() if field in message}
+        record["timestamp"] = log_event["timestamp"]
+        records.append(record)
+
+    return records
+
+
+def aggregate_usage(records):
+    """
+    Prices the records and sums them per tenant, model and minute
+    """
+    df = pd.DataFrame.from_records(records)
+    df["minute"] = pd.to_datetime(df["timestamp"], unit="ms", utc=True).dt.strftime("%Y-%m-%dT%H:%M")
+
+    df = calculate_costs(df)
+
+    return df.groupby(["tenant_id", "model_id", "minute"])[METRICS].sum()
+
+
+def get_key(tenant_id, model_id, minute):
+    return f"{RECORD_TYPE}#{tenant_id}#{model_id}#{minute}"
+
+
+def get_batch_id(payload):
+    log_events = payload["logEvents"]
+    batch = f"{payload['logGroup']}|{payload['logStream']}|{log_events[0]['id']}|{log_events[-1]['id']}|{len(log_events)}"
+
+    return hashlib.sha256(batch.encode("utf-8")).hexdigest()
+
+
+def _to_attribute(value):
+    if isinstance(value, float):
+        value = Decimal(str(value))
+    elif isinstance(value, int):
+        value = Decimal(value)
+
+    return serializer.serialize(value)
+
+
+def _get_update(tenant_id, model_id, minute, row, ttl):
+    values = {
+        ":record_type": RECORD_TYPE,
+        ":tenant_id": tenant_id,
+        ":model_id": model_id,
+        ":minute": minute,
+        ":ttl": ttl,
+        **{f":{metric}": float(row[metric]) for metric in METRICS}
+    }
+
+    return {
+        "Update": {
+            "TableName": table_name,
+            "Key": {"pk": {"S": get_key(tenant_id, model_id, minute)}},
+            "UpdateExpression": (
+                "SET record_type = :record_type, tenant_id = :tenant_id, model_id = :model_id, "
+                "#minute = :minute, #ttl = :ttl "
+                "ADD " + ", ".join(f"{metric} :{metric}" for metric in METRICS)
+            ),
+            "ExpressionAttributeNames": {"#minute": "minute", "#ttl": "ttl"},
+            "ExpressionAttributeValues": {key: _to_attribute(value) for key, value in values.items()}
+        }
+    }
+
+
+def _get_dynamodb_client():
+    global dynamodb_client
+
+    if dynamodb_client is None:
+        dynamodb_client = boto3.client("dynamodb")
+
+    return dynamodb_client
+
+
+def _write_transaction(marker_key, updates):
+    """
+    Applies the updates together with a marker item, a redelivered batch fails the marker condition and is skipped
+    """
+    marker = {
+        "Put": {
+            "TableName": table_name,
+            "Item": {
+                "pk": {"S": marker_key},
+                "record_type": {"S": MARKER_RECORD_TYPE},
+                "ttl": {"N": str(int(time.time()) + batch_marker_ttl)}
+            },
+            "ConditionExpression": "attribute_not_exists(pk)"
+        }
+    }
+
+    client = _get_dynamodb_client()
+
+    for attempt in range(transaction_max_attempts):
+        try:
+            client.transact_write_items(TransactItems=[marker] + updates)
+            return True
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get("CancellationReasons", [])
+            if reasons and reasons[0].get("Code") == "ConditionalCheckFailed":
+                logger.info(f"Batch {marker_key} was already merged, skipping")
+                return False
+
+            # conflicts with concurrent batches updating the same minute are retried
+            if attempt == transaction_max_attempts - 1:
+                raise
+
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+
+def merge_usage(df_aggregated, batch_id):
+    ttl = int(time.time()) + usage_ttl_days * 24 * 3600
+    updates = [
+        _get_update(tenant_id, model_id, minute, row, ttl)
+        for (tenant_id, model_id, minute), row in df_aggregated.iterrows()
+    ]
+
+    merged = 0
+    for index in range(0, len(updates), TRANSACTION_MAX_UPDATES):
+        chunk = updates[index:index + TRANSACTION_MAX_UPDATES]
+        if _write_transaction(f"{MARKER_RECORD_TYPE}#{batch_id}#{index}", chunk):
+            merged += len(chunk)
+
+    return merged
+
+
+def process_event(event):
+    try:
+        payload = decode_payload(event)
+        records = parse_usage_records(payload)
+
+        if len(records) == 0:
+            return 0
+
+        df_aggregated = aggregate_usage(records)
+
+        merged = merge_usage(df_aggregated, get_batch_id(payload))
+        logger.info(f"Merged {len(records)} usage records into {merged} tenant/model/minute items")
+
+        return len(records)
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        logger.error(stacktrace)
+
+        raise e
+
+
+def lambda_handler(event, context):
+    # errors are raised so the asynchronous invocation is retried, the batch marker keeps retries idempotent
+    records = process_event(event)
+
+    return {"statusCode": 200, "body": json.dumps({"records": records})}
+
+
+def make_event(log_events, log_group="/aws/lambda/bedrock_invoke_model", log_stream="replay"):
+    """
+    Builds a subscription filter event from log events, e.g. the "events" of `aws logs filter-log-events`
+    """
+    payload = {
+        "messageType": "DATA_MESSAGE",
+        "logGroup": log_group,
+        "logStream": log_stream,
+        "subscriptionFilters": ["replay"],
+        "logEvents": [
+            {"id": str(log_event.get("eventId", index)), "timestamp": log_event["timestamp"], "message": log_event["message"]}
+            for index, log_event in enumerate(log_events)
+        ]
+    }
+
+    return {"awslogs": {"data": base64.b64encode(gzip.compress(json.dumps(payload).encode("utf-8"))).decode("utf-8")}}
+
+
+def _load_events(path):
+    with open(path, "r", encoding="utf-8") as f:
+        content = json.load(f)
+
+    # recorded subscription events, a list of them, or the output of filter-log-events
+    if isinstance(content, list):
+        return content
+    if "awslogs" in content:
+        return [content]
+
+    return [make_event(content["events"])]
+
+
+def replay(paths, repeat=1):
+    """
+    Decodes, parses and aggregates recorded batches without writing to DynamoDB and reports the throughput
+    """
+    events = [event for path in paths for event in _load_events(path)]
+
+    records = 0
+    items = 0
+    start_time = time.perf_counter()
+
+    for _ in range(repeat):
+        for event in events:
+            batch_records = parse_usage_records(decode_payload(event))
+            if batch_records:
+                records += len(batch_records)
+                items += len(aggregate_usage(batch_records))
+
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "batches": len(events) * repeat,
+        "records": records,
+        "items": items,
+        "seconds": elapsed,
+        "records_per_sec": records / elapsed if elapsed > 0 else float("inf")
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replays recorded subscription filter batches through the consumer")
+    parser.add_argument("paths", nargs="+", help="JSON files with subscription events or filter-log-events output")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    print(json.dumps(replay(args.paths, args.repeat), indent=2))
@@ -0,0 +1,177 @@
+"""
+Benchmarks calculate_costs, the vectorized pricing of the cost tracking functions, on synthetic Logs Insights rows.
+
+    python benchmark_pricing.py [--sizes 100000 1000000 10000000] [--strings-max 1000000] [--baseline-rows 20000]
+
+Frames up to --strings-max rows carry string fields, as get_query_results returns them. Larger frames use numeric
+columns, like the rows of the aggregated query and the usage stream, so 10M rows fit in about 3 GB of memory.
+The row-wise apply that calculate_costs replaced runs on --baseline-rows rows of the first frame of each field
+type. Its costs are compared with the vectorized ones, and its time is extrapolated to the sizes of that type.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "cost_tracking")
+
+sys.path.insert(0, LAMBDA_DIR)
+# models.json is read relative to the working directory, as in the function
+os.chdir(LAMBDA_DIR)
+
+from utils import calculate_costs  # noqa: E402
+
+UNPRICED_MODEL = "unknown.model-v1"
+
+
+def make_rows(n, strings, seed=0):
+    """
+    Invocations spread over every priced (model_id, region) pair and one unknown model
+    """
+    with open("models.json", "r", encoding="utf-8") as f:
+        model_list = json.load(f)
+
+    pairs = [
+        (model_id, region)
+        for models in model_list.values()
+        for model_id, regions in models.items()
+        for region in regions
+    ] + [(UNPRICED_MODEL, "us-east-1")]
+
+    rng = np.random.default_rng(seed)
+    pair_index = rng.integers(0, len(pairs), n)
+    input_tokens = rng.integers(1, 4000, n)
+
+    columns = {
+        "model_id": np.array([model_id for model_id, _ in pairs], dtype=object)[pair_index],
+        "region": np.array([region for _, region in pairs], dtype=object)[pair_index],
+        "input_tokens": input_tokens,
+        "output_tokens": rng.integers(1, 2000, n),
+        "saved_input_tokens": np.where(rng.random(n) < 0.05, input_tokens, 0),
+        "saved_output_tokens": np.zeros(n, dtype=np.int64),
+        "height": rng.choice([512, 1024], n),
+        "width": rng.choice([512, 1024], n),
+        "steps": rng.choice([30, 60], n),
+    }
+    del input_tokens, pair_index
+
+    if strings:
+        for column in list(columns):
+            if column not in ("model_id", "region"):
+                columns[column] = columns[column].astype(str).astype(object)
+
+    return pd.DataFrame(columns)
+
+
+def _get_pricing(model_id, model_prices):
+    matched = [v for k, v in model_prices.items() if model_id in k]
+
+    return matched[0] if matched else None
+
+
+def calculate_cost_rowwise(row):
+    """
+    The per-row pricing calculate_costs replaced, kept as the reference for the results and the timings.
+    Like the original it reads models.json for every row.
+    """
+    with open("models.json", "r", encoding="utf-8") as f:
+        model_list = json.load(f)
+
+    model_id = row["model_id"]
+    region = row["region"]
+
+    if model_id in model_list["text"] or model_id in model_list["embeddings"]:
+        models = model_list["text"] if model_id in model_list["text"] else model_list["embeddings"]
+        pricing = _get_pricing(region, _get_pricing(model_id, models))
+        input_tokens = float(row["input_tokens"])
+        output_tokens = float(row["output_tokens"])
+
+        return input_tokens * pricing["input_cost"] / 1000, output_tokens * pricing["output_cost"] / 1000
+
+    if model_id in model_list["image"]:
+        pricing = _get_pricing(region, _get_pricing(model_id, model_list["image"]))
+        size = "512x512" if float(row["width"]) <= 512 and float(row["height"]) <= 512 else "larger"
+        pricing = _get_pricing(size, pricing)
+
+        return 0.0, pricing["premium"] if float(row["steps"]) > 50 else pricing["standard"]
+
+    return 0.0, 0.0
+
+
+def run_baseline(df):
+    start_time = time.perf_counter()
+    costs = df.apply(calculate_cost_rowwise, axis=1, result_type="expand")
+    elapsed = time.perf_counter() - start_time
+
+    return costs.rename(columns={0: "input_cost", 1: "output_cost"}), elapsed
+
+
+def _get_peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the vectorized pricing against the row-wise apply")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000, 10_000_000])
+    parser.add_argument("--strings-max", type=int, default=1_000_000)
+    parser.add_argument("--baseline-rows", type=int, default=20_000)
+    args = parser.parse_args()
+
+    # row-wise rows/sec per field type
+    baseline_rows_per_sec = {}
+    results = []
+
+    for size in args.sizes:
+        strings = size <= args.strings_max
+        df = make_rows(size, strings)
+
+        start_time = time.perf_counter()
+        priced = calculate_costs(df)
+        elapsed = time.perf_counter() - start_time
+
+        fields = "string" if strings else "numeric"
+        if fields not in baseline_rows_per_sec and args.baseline_rows > 0:
+            sample = df.iloc[:args.baseline_rows]
+            baseline, baseline_elapsed = run_baseline(sample)
+            baseline_rows_per_sec[fields] = len(sample) / baseline_elapsed
+
+            max_diff = max(
+                (baseline[column] - priced[column].iloc[:len(sample)].values).abs().max()
+                for column in ["input_cost", "output_cost"]
+            )
+            print(f"row-wise ({fields} fields): {len(sample)} rows in {baseline_elapsed:.2f}s, max abs cost difference {max_diff}")
+
+        result = {
+            "rows": size,
+            "fields": fields,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(size / elapsed),
+            "baseline_seconds_estimate": (
+                round(size / baseline_rows_per_sec[fields], 1) if fields in baseline_rows_per_sec else None
+            ),
+            "peak_rss_mb": round(_get_peak_rss_mb())
+        }
+        results.append(result)
+        print(json.dumps(result))
+
+        del df, priced
+
+    if args.baseline_rows > 0:
+        print()
+        print(f"{'rows':>10} {'fields':>8} {'vectorized':>11} {'row-wise (est.)':>16} {'speedup':>8}")
+        for result in results:
+            speedup = result["baseline_seconds_estimate"] / result["seconds"]
+            print(
+                f"{result['rows']:>10} {result['fields']:>8} {result['seconds']:>10.2f}s "
+                f"{result['baseline_seconds_estimate']:>15.1f}s {speedup:>7.0f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Fits the token estimator profiles of the invoke model function.
+
+    python fit_token_profiles.py logs --log-group /aws/lambda/<prefix>_bedrock_invoke_model [--days 7]
+    python fit_token_profiles.py tokenizer --provider meta --tokenizer llama3:tokenizer.model --texts docs/
+
+logs queries the estimatedInputTokens and inputTokens that invoke_model logs for every request and fits the
+scale and overhead of each provider's profile, so the estimates match the usage Bedrock reported. The prompts
+are not logged, so the other constants are kept, and the logs must have been written with the current profiles.
+
+tokenizer counts sample texts with a local copy of the provider's tokenizer (tiktoken for llama3, sentencepiece
+for a .model file) and searches all the constants of the profile. The samples are the paragraphs of the text
+files, joined up to --max-chars characters.
+
+Both print the error of the current and the fitted profile, and the fitted profiles to copy into PROFILES.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(SCRIPTS_DIR, "..", "lambdas", "invoke_model"))
+
+import token_counter  # noqa: E402
+from token_counter import PROFILES, count_tokens_batch, get_profile  # noqa: E402
+
+QUERY = """
+fields message.requestId as request_id,
+message.model_id as model_id,
+message.estimatedInputTokens as estimated_input_tokens,
+message.inputTokens as input_tokens
+| filter level = "INFO" and ispresent(message.estimatedInputTokens) and message.inputTokens > 0
+"""
+
+# the pattern of the Llama 3 tokenizer, tokenizer.model only holds the ranks
+LLAMA3_PATTERN = (
+    r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"
+)
+
+GRID = {
+    "word_chars": range(2, 13),
+    "subword_chars": np.arange(2.0, 8.5, 0.5).tolist(),
+    "digit_chars": [1, 2, 3],
+    "punctuation_ratio": [0.25, 0.5, 0.75, 1.0],
+    "non_ascii_ratio": [0.5, 1.0, 1.5, 2.0],
+}
+
+
+def get_errors(estimates, actuals):
+    estimates = np.asarray(estimates, dtype=np.float64)
+    actuals = np.asarray(actuals, dtype=np.float64)
+    pct_errors = (estimates - actuals) / actuals
+
+    return {
+        "mean_pct_error": round(float(pct_errors.mean()) * 100, 1),
+        "mean_abs_pct_error": round(float(np.abs(pct_errors).mean()) * 100, 1),
+        "p90_abs_pct_error": round(float(np.percentile(np.abs(pct_errors), 90)) * 100, 1)
+    }
+
+
+def fit_scale(text_tokens, actuals, overhead):
+    """
+    Least squares scale of the text tokens with the overhead fixed
+    """
+    text_tokens = np.asarray(text_tokens, dtype=np.float64)
+    actuals = np.asarray(actuals, dtype=np.float64)
+
+    return round(float((text_tokens * (actuals - overhead)).sum() / (text_tokens ** 2).sum()), 3)
+
+
+def fit_linear(text_tokens, actuals):
+    """
+    Least squares scale and non negative whole overhead
+    """
+    matrix = np.column_stack([text_tokens, np.ones(len(text_tokens))])
+    _, overhead = np.linalg.lstsq(matrix, np.asarray(actuals, dtype=np.float64), rcond=None)[0]
+    overhead = max(int(round(overhead)), 0)
+
+    return fit_scale(text_tokens, actuals, overhead), overhead
+
+
+def get_provider(model_id):
+    # the provider of a model id, as invoke_model resolves it
+    return model_id.split(".")[0]
+
+
+def fit_logs(args):
+    sys.path.insert(0, os.path.join(SCRIPTS_DIR, "..", "lambdas", "cost_tracking"))
+    from utils import results_to_df, run_query
+
+    end_time = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    results = run_query(QUERY, args.log_group, time_range=(end_time - args.days * 24 * 3600, end_time))
+    df = results_to_df(results)
+    if len(df) == 0:
+        print("No requests with estimatedInputTokens were logged in the range")
+        return {}
+
+    df["provider"] = df["model_id"].map(get_provider)
+    df["estimated_input_tokens"] = df["estimated_input_tokens"].astype("int64")
+    df["input_tokens"] = df["input_tokens"].astype("int64")
+
+    fitted = {}
+    for provider, df_provider in df.groupby("provider"):
+        profile = get_profile(provider)
+
+        # the text tokens before the logged scale and overhead were applied
+        text_tokens = ((df_provider["estimated_input_tokens"] - profile["overhead"]) / profile["scale"]).clip(lower=1)
+        scale, overhead = fit_linear(text_tokens, df_provider["input_tokens"])
+        fitted[provider] = {**profile, "scale": scale, "overhead": overhead}
+
+        estimates = np.ceil(text_tokens * scale) + overhead
+        print(json.dumps({
+            "provider": provider,
+            "requests": len(df_provider),
+            "current": get_errors(df_provider["estimated_input_tokens"], df_provider["input_tokens"]),
+            "fitted": get_errors(estimates, df_provider["input_tokens"])
+        }))
+
+    return fitted
+
+
+def _load_tokenizer(spec):
+    kind, path = spec.split(":", 1)
+
+    if kind == "llama3":
+        import tiktoken
+        from tiktoken.load import load_tiktoken_bpe
+
+        encoding = tiktoken.Encoding(name="llama3", pat_str=LLAMA3_PATTERN, mergeable_ranks=load_tiktoken_bpe(path), special_tokens={})
+        # the begin of text token
+        return lambda text: len(encoding.encode(text)) + 1
+
+    if kind == "sentencepiece":
+        import sentencepiece
+
+        processor = sentencepiece.SentencePieceProcessor(model_file=path)
+        return lambda text: len(processor.encode(text, add_bos=True))
+
+    raise ValueError(f"Unknown tokenizer {kind}, use llama3:<path> or sentencepiece:<path>")
+
+
+def _load_texts(paths, max_chars):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(root, name) for root, _, names in os.walk(path) for name in sorted(names))
+        else:
+            files.append(path)
+
+    texts = []
+    for file in files:
+        try:
+            with open(file, "r", encoding="utf-8") as f:
+                paragraphs = [paragraph.strip() for paragraph in f.read().split("\n\n") if paragraph.strip()]
+        except (UnicodeDecodeError, OSError):
+            continue
+
+        text = ""
+        for paragraph in paragraphs:
+            if text and len(text) + len(paragraph) > max_chars:
+                texts.append(text)
+                text = ""
+            text = f"{text}\n\n{paragraph}" if text else paragraph[:max_chars]
+        if text:
+            texts.append(text)
+
+    return texts
+
+
+def get_features(texts):
+    """
+    Per text histograms of the word and digit run lengths and the counts of the other token sources, the token
+    estimate of every profile is a linear function of them
+    """
+    max_length = token_counter._MAX_TABLE_LENGTH
+    words = np.zeros((len(texts), max_length + 1))
+    digits = np.zeros((len(texts), max_length + 1))
+    counts = np.zeros((len(texts), 3))
+
+    for index, text in enumerate(texts):
+        data = text.encode("ascii", "ignore")
+        for histogram, table in [(words, token_counter._WORD_BYTES), (digits, token_counter._DIGIT_BYTES)]:
+            lengths = np.minimum([len(run) for run in data.translate(table).split()], max_length).astype(np.int64)
+            histogram[index] = np.bincount(lengths, minlength=max_length + 1)
+
+        counts[index] = [
+            len(data) - len(data.translate(None, token_counter._PUNCTUATION_BYTES)),
+            len(token_counter._NEWLINES.findall(data)),
+            len(text) - len(data)
+        ]
+
+    return words, digits, counts
+
+
+def get_text_tokens(features, word_chars, subword_chars, digit_chars, punctuation_ratio, non_ascii_ratio):
+    words, digits, counts = features
+    lengths = np.arange(words.shape[1])
+
+    word_tokens = np.where(lengths <= word_chars, 1, np.ceil(lengths / subword_chars))
+    word_tokens[0] = 0
+    digit_tokens = np.ceil(lengths / digit_chars)
+
+    return (
+        words @ word_tokens + digits @ digit_tokens + np.ceil(counts[:, 0] * punctuation_ratio) + counts[:, 1]
+        + np.ceil(counts[:, 2] * non_ascii_ratio)
+    )
+
+
+def fit_tokenizer(args):
+    count = _load_tokenizer(args.tokenizer)
+    texts = _load_texts(args.texts, args.max_chars)
+    actuals = np.array([count(text) for text in texts], dtype=np.float64)
+
+    # the tokens of an empty prompt are the template overhead
+    overhead = count("")
+    current = get_profile(args.provider)
+
+    features = get_features(texts)
+
+    best = None
+    for values in itertools.product(*GRID.values()):
+        profile = dict(zip(GRID, values))
+        text_tokens = get_text_tokens(features, **profile)
+        scale = fit_scale(text_tokens, actuals, overhead)
+
+        error = np.abs((np.ceil(text_tokens * scale) + overhead - actuals) / actuals).mean()
+        if best is None or error < best[0]:
+            best = (error, {**profile, "scale": scale, "overhead": overhead})
+
+    fitted = best[1]
+
+    start_time = time.perf_counter()
+    estimates = count_tokens_batch(texts, profile=fitted)
+    elapsed = time.perf_counter() - start_time
+
+    print(json.dumps({
+        "provider": args.provider,
+        "texts": len(texts),
+        "characters": sum(map(len, texts)),
+        "tokens": int(actuals.sum()),
+        "current": get_errors(count_tokens_batch(texts, profile=current), actuals),
+        "fitted": get_errors(estimates, actuals),
+        "len/4": get_errors([max(len(text) // 4, 1) for text in texts], actuals),
+        "strings_per_sec": round(len(texts) / elapsed)
+    }))
+
+    return {args.provider: fitted}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fits the token estimator profiles")
+    subparsers = parser.add_subparsers(dest="source", required=True)
+
+    logs_parser = subparsers.add_parser("logs", help="scale and overhead from the logged estimates and usage")
+    logs_parser.add_argument("--log-group", required=True)
+    logs_parser.add_argument("--days", type=int, default=7)
+
+    tokenizer_parser = subparsers.add_parser("tokenizer", help="every constant from a local tokenizer")
+    tokenizer_parser.add_argument("--provider", required=True, choices=sorted(PROFILES))
+    tokenizer_parser.add_argument("--tokenizer", required=True, help="llama3:<tokenizer.model> or sentencepiece:<file.model>")
+    tokenizer_parser.add_argument("--texts", nargs="+", required=True, help="text files or directories of them")
+    tokenizer_parser.add_argument("--max-chars", type=int, default=2000)
+    args = parser.parse_args()
+
+    fitted = fit_logs(args) if args.source == "logs" else fit_tokenizer(args)
+
+    print()
+    for provider, profile in fitted.items():
+        print(f'    "{provider}": {json.dumps(profile)},')
+
+
+if __name__ == "__main__":
+    main()
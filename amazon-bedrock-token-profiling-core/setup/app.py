@@ -1,11 +1,13 @@
 from aws_cdk import (
     App,
     CfnOutput,
+    Duration,
     RemovalPolicy,
     Stack,
     Tags,
     aws_s3,
     aws_apigateway as apigw,
+    aws_lambda,
 )
 from constructs import Construct
 import json
@@ -16,6 +18,7 @@ from stack_constructs.dynamodb import DynamoDB
 from stack_constructs.iam import IAM
 from stack_constructs.lambda_function import LambdaFunction
 from stack_constructs.lambda_layer import LambdaLayer
+from stack_constructs.log_subscription import LogSubscription
 from stack_constructs.network import Network
 from stack_constructs.scheduler import LambdaFunctionScheduler
 from stack_constructs.cognito import Cognito
@@ -56,8 +59,11 @@ class BedrockAPIStack(Stack):
         if self.bedrock_runtime_endpoint_url is not None:
             self.bedrock_runtime_endpoint_url = self.bedrock_runtime_endpoint_url.format(self.region)
         self.bedrock_requirements = config.get("BEDROCK_REQUIREMENTS", None)
-        self.langchain_requirements = config.get("LANGCHAIN_REQUIREMENTS", None)
+        self.powertools_requirements = config.get("POWERTOOLS_REQUIREMENTS", None)
         self.pandas_requirements = config.get("PANDAS_REQUIREMENTS", None)
+        self.aws_sdk_pandas_layer_arn = config.get("AWS_SDK_PANDAS_LAYER_ARN", None)
+        if self.aws_sdk_pandas_layer_arn is not None:
+            self.aws_sdk_pandas_layer_arn = self.aws_sdk_pandas_layer_arn.format(self.region)
         self.api_throttling_rate = config.get("API_THROTTLING_RATE", 10000)
         self.api_burst_rate = config.get("API_BURST_RATE", 10000)
         self.api_gw_id = config.get("API_GATEWAY_ID", None)
@@ -69,7 +75,7 @@ class BedrockAPIStack(Stack):
         if self.prefix_id is None:
             raise Exception("STACK_PREFIX not defined")
 
-        if self.vpc_cidr is not None and self.bedrock_endpoint_url is not None and self.bedrock_requirements is not None and self.langchain_requirements is not None and self.pandas_requirements is not None:
+        if self.vpc_cidr is not None and self.bedrock_endpoint_url is not None and self.bedrock_requirements is not None and self.powertools_requirements is not None and self.pandas_requirements is not None and self.aws_sdk_pandas_layer_arn is not None:
             self.full_deployment = True
         else:
             if self.api_gw_id is not None and self.api_gw_resource_id is not None:
@@ -113,6 +119,7 @@ class BedrockAPIStack(Stack):
         )
 
         table = dynamodb_class.build()
+        cost_table = dynamodb_class.build_cost_table()
 
         # ==================================================
         # ================= S3 BUCKETS =====================
@@ -152,11 +159,11 @@ class BedrockAPIStack(Stack):
             }
         )
 
-        langchain_layer = lambda_layer.build(
-            layer_name=f"{self.prefix_id}_langchain_layer",
+        powertools_layer = lambda_layer.build(
+            layer_name=f"{self.prefix_id}_powertools_layer",
             code_dir=f"{self.lambdas_directory}/lambda_layer_requirements",
             environments={
-                "REQUIREMENTS": self.langchain_requirements,
+                "REQUIREMENTS": self.powertools_requirements,
                 "S3_BUCKET": s3_bucket_layer.bucket_name
             }
         )
@@ -170,6 +177,13 @@ class BedrockAPIStack(Stack):
             }
         )
 
+        # pandas with pyarrow for the functions writing Parquet, pip installing both exceeds the layer size limit
+        aws_sdk_pandas_layer = aws_lambda.LayerVersion.from_layer_version_arn(
+            self,
+            f"{self.prefix_id}_aws_sdk_pandas_layer",
+            self.aws_sdk_pandas_layer_arn
+        )
+
         # ==================================================
         # ============= BEDROCK FUNCTIONS ==================
         # ==================================================
@@ -179,26 +193,6 @@ class BedrockAPIStack(Stack):
             id=f"{self.prefix_id}_lambda_function",
             role=iam_role.role_name,
         )
-        """
-        bedrock_invoke_model_streaming = lambda_function.build(
-            function_name=f"{self.prefix_id}_bedrock_invoke_model_streaming",
-            code_dir=f"{self.lambdas_directory}/invoke_model_streaming",
-            memory=512,
-            timeout=900,
-            environment={
-                "BEDROCK_URL": self.bedrock_runtime_endpoint_url,
-                "BEDROCK_REGION": self.region,
-                "TABLE_NAME": table.table_name,
-                "S3_BUCKET": s3_bucket_configs.bucket_name,
-                "SAGEMAKER_ENDPOINTS": self.sagemaker_endpoints
-            },
-            vpc=vpc,
-            subnets=[private_subnet1, private_subnet2],
-            security_groups=[security_group],
-            layers=[boto3_layer, langchain_layer]
-        )
-        """
-
         bedrock_invoke_model = lambda_function.build(
             function_name=f"{self.prefix_id}_bedrock_invoke_model",
             code_dir=f"{self.lambdas_directory}/invoke_model",
@@ -207,7 +201,6 @@ class BedrockAPIStack(Stack):
             environment={
                 "BEDROCK_URL": self.bedrock_runtime_endpoint_url,
                 "BEDROCK_REGION": self.region,
-                #"LAMBDA_STREAMING": bedrock_invoke_model_streaming.function_name,
                 "TABLE_NAME": table.table_name,
                 "S3_BUCKET": s3_bucket_configs.bucket_name,
                 #"SAGEMAKER_ENDPOINTS": self.sagemaker_endpoints
@@ -215,7 +208,7 @@ class BedrockAPIStack(Stack):
             vpc=vpc,
             subnets=[private_subnet1, private_subnet2],
             security_groups=[security_group],
-            layers=[boto3_layer, langchain_layer]
+            layers=[boto3_layer, powertools_layer]
         )
         """
         bedrock_list_model = lambda_function.build(
@@ -241,6 +234,10 @@ class BedrockAPIStack(Stack):
             self,
             f"{self.prefix_id}_s3_bucket_cost_tracking",
             bucket_name=f"{self.prefix_id}-bucket-cost-tracking-bedrock",
+            # exports that are never resumed leave their multipart uploads behind
+            lifecycle_rules=[
+                aws_s3.LifecycleRule(abort_incomplete_multipart_upload_after=Duration.days(7))
+            ],
             auto_delete_objects=True,
             removal_policy=RemovalPolicy.DESTROY
         )
@@ -252,12 +249,13 @@ class BedrockAPIStack(Stack):
             timeout=900,
             environment={
                 "LOG_GROUP_API": f"/aws/lambda/{self.prefix_id}_bedrock_invoke_model",
-                "S3_BUCKET": s3_bucket_cost_tracking.bucket_name
+                "S3_BUCKET": s3_bucket_cost_tracking.bucket_name,
+                "COST_TABLE_NAME": cost_table.table_name
             },
             vpc=vpc,
             subnets=[private_subnet1, private_subnet2],
             security_groups=[security_group],
-            layers=[pandas_layer]
+            layers=[aws_sdk_pandas_layer]
         )
 
         bedrock_cost_tracking_manual = lambda_function.build(
@@ -268,7 +266,8 @@ class BedrockAPIStack(Stack):
             environment={
                 "LOG_GROUP_API": f"/aws/lambda/{self.prefix_id}_bedrock_invoke_model",
                 "S3_BUCKET": s3_bucket_cost_tracking.bucket_name,
-                "TABLE_NAME": table.table_name
+                "TABLE_NAME": table.table_name,
+                "COST_TABLE_NAME": cost_table.table_name
             },
             vpc=vpc,
             subnets=[private_subnet1, private_subnet2],
@@ -276,6 +275,21 @@ class BedrockAPIStack(Stack):
             layers=[pandas_layer]
         )
 
+        lambda_function.build(
+            function_name=f"{self.prefix_id}_bedrock_cost_export",
+            code_dir=f"{self.lambdas_directory}/cost_export",
+            memory=1024,
+            timeout=900,
+            environment={
+                "S3_BUCKET": s3_bucket_cost_tracking.bucket_name,
+                "COST_TABLE_NAME": cost_table.table_name
+            },
+            vpc=vpc,
+            subnets=[private_subnet1, private_subnet2],
+            security_groups=[security_group],
+            layers=[aws_sdk_pandas_layer]
+        )
+
         scheduler = LambdaFunctionScheduler(
             self,
             id=f"{self.prefix_id}_lambda_scheduler"
@@ -285,6 +299,35 @@ class BedrockAPIStack(Stack):
             lambda_function=bedrock_cost_tracking
         )
 
+        # ==================================================
+        # ============ LAMBDA USAGE STREAMING ==============
+        # ==================================================
+
+        bedrock_usage_stream = lambda_function.build(
+            function_name=f"{self.prefix_id}_bedrock_usage_stream",
+            code_dir=f"{self.lambdas_directory}/usage_stream",
+            memory=512,
+            timeout=300,
+            environment={
+                "TABLE_NAME": table.table_name
+            },
+            vpc=vpc,
+            subnets=[private_subnet1, private_subnet2],
+            security_groups=[security_group],
+            layers=[pandas_layer]
+        )
+
+        log_subscription = LogSubscription(
+            self,
+            id=f"{self.prefix_id}_usage_log_subscription"
+        )
+
+        log_subscription.build(
+            log_group_name=f"/aws/lambda/{self.prefix_id}_bedrock_invoke_model",
+            lambda_function=bedrock_usage_stream,
+            filter_pattern='{ $.level = "INFO" }'
+        )
+
         # ==================================================
         # ============= LAMBDA DDB RETRIEVAL ===============
         # ==================================================
@@ -298,6 +341,7 @@ class BedrockAPIStack(Stack):
                 "BEDROCK_URL": self.bedrock_runtime_endpoint_url,
                 "BEDROCK_REGION": self.region,
                 "TABLE_NAME": table.table_name,
+                "COST_TABLE_NAME": cost_table.table_name,
                 "S3_BUCKET": s3_bucket_configs.bucket_name,
                 #"SAGEMAKER_ENDPOINTS": self.sagemaker_endpoints
             },
@@ -353,6 +397,14 @@ class BedrockAPIStack(Stack):
             validator=True,
         )
 
+        api_invoke_batch = api_route.build(
+            lambda_function=bedrock_invoke_model,
+            route="invoke_model_batch",
+            method="POST",
+            auth=Auth,
+            validator=False,
+        )
+
         api_cost_track_manual = api_route.build(
             lambda_function=bedrock_cost_tracking_manual,
             route="cost_track_manual",
@@ -384,7 +436,7 @@ class BedrockAPIStack(Stack):
             self,
             id=f"{self.prefix_id}_api_key",
             prefix=self.prefix_id,
-            dependencies=[api_gw, api_invoke, api_cost_track_manual, api_ddb_cost_retrieval]
+            dependencies=[api_gw, api_invoke, api_invoke_batch, api_cost_track_manual, api_ddb_cost_retrieval]
         )
 
         stage = api_key_class.build(
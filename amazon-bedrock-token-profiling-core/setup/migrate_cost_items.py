@@ -0,0 +1,77 @@
+"""
+Copies the cost records written before the cost table existed into it.
+
+Old records live in the shared table as pk=<tenant>-<model> items with string attributes, one per tenant and
+model holding the last aggregated day. Items of the other record types (usage counters, budgets, cache) are
+skipped. Running it again rewrites the same items, so it can be repeated safely.
+
+    python migrate_cost_items.py --source-table <table> --target-table <cost table> [--dry-run]
+"""
+import argparse
+import boto3
+from boto3.dynamodb.conditions import Attr
+from decimal import Decimal, InvalidOperation
+
+METRICS = ["input_tokens", "output_tokens", "input_cost", "output_cost", "saved_cost", "invocations", "unpriced_invocations"]
+
+
+def _to_number(value):
+    try:
+        return Decimal(str(value))
+    except InvalidOperation:
+        return Decimal(0)
+
+
+def convert_item(item):
+    if "name" not in item or "model_id" not in item or "date" not in item:
+        return None
+
+    return {
+        "tenant_id": item["name"],
+        "sk": f"{item['date']}#{item['model_id']}",
+        "date": item["date"],
+        "model_id": item["model_id"],
+        **{metric: _to_number(item[metric]) for metric in METRICS if metric in item}
+    }
+
+
+def migrate(source_table_name, target_table_name, dry_run=False):
+    dynamodb = boto3.resource("dynamodb")
+    source_table = dynamodb.Table(source_table_name)
+    target_table = dynamodb.Table(target_table_name)
+
+    scanned = 0
+    migrated = 0
+    skipped = 0
+
+    kwargs = {"FilterExpression": Attr("record_type").not_exists()}
+    with target_table.batch_writer() as writer:
+        while True:
+            response = source_table.scan(**kwargs)
+
+            for item in response["Items"]:
+                scanned += 1
+                converted = convert_item(item)
+                if converted is None:
+                    skipped += 1
+                    continue
+
+                if not dry_run:
+                    writer.put_item(Item=converted)
+                migrated += 1
+
+            if "LastEvaluatedKey" not in response:
+                break
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    return {"scanned": scanned, "migrated": migrated, "skipped": skipped, "dry_run": dry_run}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrates the string cost records to the cost table")
+    parser.add_argument("--source-table", required=True)
+    parser.add_argument("--target-table", required=True)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    print(migrate(args.source_table, args.target_table, args.dry_run))
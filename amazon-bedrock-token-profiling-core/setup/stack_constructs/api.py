@@ -52,7 +52,7 @@ class API(Construct):
                 api_key_required=False,
                 request_parameters={
                     "method.request.header.Auth": True,
-                    #"method.request.header.streaming": False,
+                    "method.request.header.streaming": False,
                     #"method.request.header.type": False
                 },
                 request_validator_options={
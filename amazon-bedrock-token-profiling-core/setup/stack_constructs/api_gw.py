@@ -1,7 +1,8 @@
 from constructs import Construct
 from aws_cdk import (
     aws_apigateway as apigw,
-    Duration
+    Duration,
+    Size
 )
 
 class APIGW(Construct):
@@ -27,6 +28,8 @@ class APIGW(Construct):
             id=f"{self.id}_api_gateway",
             rest_api_name=self.api_gw_name,
             deploy=False,
+            # responses above 1 KiB are gzipped for clients sending Accept-Encoding
+            min_compression_size=Size.kibibytes(1),
             default_cors_preflight_options=apigw.CorsOptions(
                 allow_origins=["*"],
                 allow_methods=["*"],
@@ -23,6 +23,12 @@ class Cognito(Construct):
                 #logout_urls=["https://my-app-domain.com/signin"]
             )
         )
+        # members of the admin group get the costs of every tenant from the cost retrieval function
+        cognito.CfnUserPoolGroup(self, "AdminGroup",
+            user_pool_id=pool.user_pool_id,
+            group_name="admin",
+            description="Reads the costs of every tenant"
+        )
         CfnOutput(self, "UserPoolId", value=pool.user_pool_id).override_logical_id('UserPoolId')
         CfnOutput(self, "UserPoolClientId", value=client.user_pool_client_id).override_logical_id('UserPoolAppClientId')
         return pool
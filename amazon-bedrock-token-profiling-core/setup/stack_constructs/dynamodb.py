@@ -32,3 +32,37 @@ class DynamoDB(Construct):
             table.node.add_dependency(el)
 
         return table
+
+    def build_cost_table(self):
+        # one item per tenant, day and model, the date index serves the cross-tenant views
+        table = ddb.Table(
+            self,
+            "saas-bedrock-cost-records",
+            partition_key=ddb.Attribute(
+                name="tenant_id",
+                type=ddb.AttributeType.STRING
+            ),
+            sort_key=ddb.Attribute(
+                name="sk",
+                type=ddb.AttributeType.STRING
+            ),
+            billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        table.add_global_secondary_index(
+            index_name="date-index",
+            partition_key=ddb.Attribute(
+                name="date",
+                type=ddb.AttributeType.STRING
+            ),
+            sort_key=ddb.Attribute(
+                name="tenant_id",
+                type=ddb.AttributeType.STRING
+            )
+        )
+
+        for el in self.dependencies:
+            table.node.add_dependency(el)
+
+        return table
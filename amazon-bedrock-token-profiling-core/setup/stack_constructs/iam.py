@@ -78,10 +78,13 @@ class IAM(Construct):
                 effect=iam.Effect.ALLOW,
                 actions=[
                     "dynamodb:BatchGetItem",
+                    "dynamodb:BatchWriteItem",
                     "dynamodb:DeleteItem",
                     "dynamodb:GetItem",
                     "dynamodb:PutItem",
-                    "dynamodb:Scan"
+                    "dynamodb:Query",
+                    "dynamodb:Scan",
+                    "dynamodb:UpdateItem"
                     ],
                 resources=['*']))
         dynamodb_policy = iam.ManagedPolicy(
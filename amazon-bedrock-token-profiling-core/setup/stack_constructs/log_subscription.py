@@ -0,0 +1,62 @@
+from constructs import Construct
+from aws_cdk import (
+    aws_lambda as lambda_,
+    aws_logs as logs,
+    aws_logs_destinations as destinations,
+    custom_resources as cr
+)
+
+
+class LogSubscription(Construct):
+    def __init__(
+        self,
+        scope: Construct,
+        id: str,
+        dependencies: list = []
+    ):
+        super().__init__(scope, id)
+
+        self.id = id
+        self.dependencies = dependencies
+
+    def build(
+        self,
+        log_group_name: str,
+        lambda_function: lambda_.Function,
+        filter_pattern: str
+    ):
+        # ==================================================
+        # =============== LOG SUBSCRIPTION =================
+        # ==================================================
+
+        # Lambda creates its log group on the first invocation, make sure it exists before subscribing
+        log_group_resource = cr.AwsCustomResource(
+            scope=self,
+            id=f"{self.id}_log_group",
+            on_create=cr.AwsSdkCall(
+                service="CloudWatchLogs",
+                action="createLogGroup",
+                parameters={"logGroupName": log_group_name},
+                physical_resource_id=cr.PhysicalResourceId.of(log_group_name),
+                ignore_error_codes_matching="ResourceAlreadyExistsException"
+            ),
+            policy=cr.AwsCustomResourcePolicy.from_sdk_calls(
+                resources=cr.AwsCustomResourcePolicy.ANY_RESOURCE
+            )
+        )
+
+        log_group = logs.LogGroup.from_log_group_name(self, f"{self.id}_log_group_ref", log_group_name)
+
+        subscription_filter = logs.SubscriptionFilter(
+            scope=self,
+            id=f"{self.id}_subscription_filter",
+            log_group=log_group,
+            destination=destinations.LambdaDestination(lambda_function),
+            filter_pattern=logs.FilterPattern.literal(filter_pattern)
+        )
+        subscription_filter.node.add_dependency(log_group_resource)
+
+        for el in self.dependencies:
+            subscription_filter.node.add_dependency(el)
+
+        return subscription_filter
@@ -0,0 +1,32 @@
+"""
+Builds the Bedrock request bodies of the invoke model function.
+
+    cd amazon-bedrock-token-profiling-core && python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "invoke_model"))
+
+import adapters  # noqa: E402
+
+
+def test_anthropic_maps_the_api_parameters_and_drops_the_others():
+    body = adapters.prepare_input(
+        "anthropic", "What is Amazon.com?", {"maxTokenCount": 4096, "temperature": 0.8, "topP": 0.9, "unknown": 1}
+    )
+
+    assert body == {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 4096,
+        "temperature": 0.8,
+        "top_p": 0.9,
+        "messages": [{"role": "user", "content": [{"type": "text", "text": "What is Amazon.com?"}]}]
+    }
+
+
+def test_anthropic_defaults_max_tokens():
+    body = adapters.prepare_input("anthropic", "What is Amazon.com?", {})
+
+    assert body["max_tokens"] == 1000
+    assert set(body) == {"anthropic_version", "max_tokens", "messages"}
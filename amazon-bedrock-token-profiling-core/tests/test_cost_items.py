@@ -0,0 +1,112 @@
+"""
+Runs the atomic cost item additions of the cost tracking functions against an in-memory table.
+
+    cd amazon-bedrock-token-profiling-core && python -m pytest tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import threading
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "cost_tracking"))
+
+import utils  # noqa: E402
+
+DATE = "2024-06-03"
+
+
+class FakeDynamoDB:
+    """
+    Applies the SET and ADD clauses of transactional updates atomically, like DynamoDB does
+    """
+
+    class exceptions:
+        class TransactionCanceledException(Exception):
+            pass
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def _key(self, key):
+        key = {name: utils._deserializer.deserialize(value) for name, value in key.items()}
+        return key["tenant_id"], key["sk"]
+
+    def _update(self, Key, UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames=None, **kwargs):
+        names = ExpressionAttributeNames or {}
+        values = {name: utils._deserializer.deserialize(value) for name, value in ExpressionAttributeValues.items()}
+        item = self.items.setdefault(self._key(Key), dict(zip(["tenant_id", "sk"], self._key(Key))))
+
+        set_clause, add_clause = UpdateExpression.split(" ADD ")
+        for assignment in set_clause[len("SET "):].split(", "):
+            name, value = assignment.split(" = ")
+            item[names.get(name, name)] = values[value]
+        for addition in add_clause.split(", "):
+            name, value = addition.split(" ")
+            item[names.get(name, name)] = item.get(names.get(name, name), 0) + values[value]
+
+    def transact_write_items(self, TransactItems):
+        with self.lock:
+            for transact_item in TransactItems:
+                self._update(**transact_item["Update"])
+
+    def update_item(self, TableName, **kwargs):
+        with self.lock:
+            self._update(**kwargs)
+
+    def batch_get_item(self, RequestItems):
+        table_name, request = next(iter(RequestItems.items()))
+        with self.lock:
+            found = [self.items[self._key(key)] for key in request["Keys"] if self._key(key) in self.items]
+
+        return {"Responses": {table_name: [utils._serialize(item) for item in found]}}
+
+
+def make_rows(tenants, invocations=1):
+    return pd.DataFrame([
+        {
+            "tenant_id": f"tenant-{tenant}",
+            "model_id": "anthropic.claude-3-haiku-20240307-v1:0",
+            "date": DATE,
+            "input_tokens": 100 * invocations,
+            "output_tokens": 50 * invocations,
+            "input_cost": 0.25 * invocations,
+            "output_cost": 0.5 * invocations,
+            "saved_cost": 0.0,
+            "invocations": invocations,
+            "unpriced_invocations": 0
+        }
+        for tenant in range(tenants)
+    ])
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    monkeypatch.setattr(utils, "cost_rollups", True)
+    return FakeDynamoDB()
+
+
+def test_add_cost_items_returns_the_new_totals(dynamodb):
+    utils.add_cost_items(make_rows(30), "costs", dynamodb)
+    df_totals = utils.add_cost_items(make_rows(30, invocations=2), "costs", dynamodb)
+
+    assert len(df_totals) == 30
+    assert (df_totals["invocations"] == 3).all()
+    assert (df_totals["input_tokens"] == 300).all()
+
+
+def test_concurrent_additions_are_all_counted(dynamodb):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: utils.add_cost_items(make_rows(5), "costs", dynamodb), range(40)))
+
+    day_item = dynamodb.items[("tenant-0", utils.get_cost_sort_key(DATE, "anthropic.claude-3-haiku-20240307-v1:0"))]
+    assert day_item["invocations"] == 40
+    assert day_item["version"] == 40
+
+    # the rollups were added in the same transactions as the daily items
+    assert dynamodb.items[(utils.ROLLUP_ALL_TENANTS, f"day#{DATE}")]["invocations"] == 5 * 40
+    assert dynamodb.items[("tenant-0", "month#2024-06")]["input_tokens"] == 100 * 40
+    assert dynamodb.items[("tenant-0", "week#2024-W23")]["input_cost"] == pytest.approx(0.25 * 40)
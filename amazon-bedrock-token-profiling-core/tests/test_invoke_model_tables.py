@@ -0,0 +1,74 @@
+"""
+Checks that the DynamoDB helpers of the invoke model function, which the batch route shares between threads,
+only call the thread safe client of their table.
+
+    cd amazon-bedrock-token-profiling-core && python -m pytest tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "invoke_model"))
+
+from budgets import TokenBudgets  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+
+
+class FakeClient:
+    class exceptions:
+        class ConditionalCheckFailedException(Exception):
+            pass
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {"budget#tenant": {"pk": "budget#tenant", "remaining_tokens": 1000}}
+
+    def get_item(self, TableName, Key, **kwargs):
+        with self.lock:
+            item = self.items.get(Key["pk"])
+        return {"Item": dict(item)} if item is not None else {}
+
+    def put_item(self, TableName, Item):
+        with self.lock:
+            self.items[Item["pk"]] = dict(Item)
+
+    def update_item(self, TableName, Key, ExpressionAttributeValues, **kwargs):
+        with self.lock:
+            item = self.items[Key["pk"]]
+            item["remaining_tokens"] += ExpressionAttributeValues[":tokens"]
+            return {"Attributes": {"remaining_tokens": item["remaining_tokens"]}}
+
+
+class FakeTable:
+    """
+    A table resource that fails when it is used directly
+    """
+    name = "table"
+
+    def __init__(self):
+        self.meta = type("Meta", (), {"client": FakeClient()})()
+
+    def __getattr__(self, name):
+        raise AssertionError(f"Table.{name} is not thread safe")
+
+
+def test_budgets_are_consumed_through_the_client_from_many_threads():
+    table = FakeTable()
+    budgets = TokenBudgets(table)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: budgets.consume("tenant", 10), range(50)))
+
+    assert table.meta.client.items["budget#tenant"]["remaining_tokens"] == 500
+    assert budgets.has_budget("tenant", 500)
+    assert not budgets.has_budget("tenant", 501)
+
+
+def test_cache_entries_are_shared_through_the_client():
+    table = FakeTable()
+    ResponseCache(table).put("key", "answer", 10, 20)
+
+    entry = ResponseCache(table).get("key")
+
+    assert (entry["text"], entry["input_tokens"], entry["output_tokens"]) == ("answer", 10, 20)
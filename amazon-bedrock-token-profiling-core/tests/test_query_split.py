@@ -0,0 +1,157 @@
+"""
+Runs the Logs Insights query splitting of the cost tracking functions against an in-memory emulator.
+
+    cd amazon-bedrock-token-profiling-core && python -m pytest tests
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "cost_tracking"))
+
+import utils  # noqa: E402
+
+START = 1717200000  # 2024-06-01T00:00:00Z
+
+
+class FakeLogs:
+    """
+    Emulates start_query/get_query_results over (timestamp ms, request_id) events.
+
+    startTime and endTime are epoch seconds. With inclusive_end the whole endTime second is part of the window,
+    otherwise the window ends exactly at endTime.000, the two ways Insights may round it. Like Insights, a query
+    returns at most limit rows.
+    """
+
+    def __init__(self, events, inclusive_end=False):
+        self.events = sorted(events)
+        self.inclusive_end = inclusive_end
+        self.queries = []
+        self.results = {}
+        self.rows_returned = 0
+
+    def start_query(self, logGroupName, startTime, endTime, queryString, limit):
+        end_ms = endTime * 1000 + (999 if self.inclusive_end else 0)
+        matched = [event for event in self.events if startTime * 1000 <= event[0] <= end_ms]
+
+        query_id = str(len(self.queries))
+        self.queries.append((startTime, endTime, len(matched)))
+        self.results[query_id] = [
+            [
+                {"field": "timestamp", "value": str(timestamp)},
+                {"field": "request_id", "value": request_id},
+                {"field": "@ptr", "value": query_id}
+            ]
+            for timestamp, request_id in matched[:limit]
+        ]
+        self.rows_returned += len(self.results[query_id])
+
+        return {"queryId": query_id}
+
+    def get_query_results(self, queryId):
+        return {"status": "Complete", "results": self.results[queryId], "statistics": {}}
+
+
+def make_events(count, start, seconds, seed=0):
+    rng = random.Random(seed)
+
+    return [(start * 1000 + rng.randrange(seconds * 1000), f"request-{seed}-{i}") for i in range(count)]
+
+
+def request_ids(results):
+    return [utils._get_field(result, "request_id") for result in results]
+
+
+def test_split_returns_every_event_of_a_window_over_the_row_cap():
+    events = make_events(45000, START, 3600)
+    logs = FakeLogs(events)
+
+    results = utils._run_split_query(logs, "query", "group", START, START + 3600)
+
+    # the first window hit the cap and was split until every window fit under it
+    assert logs.queries[0][2] > utils.QUERY_RESULTS_LIMIT
+    assert len(logs.queries) > 1
+    assert set(request_ids(results)) == {request_id for _, request_id in events}
+
+
+def test_split_recurses_into_dense_windows():
+    burst = make_events(30000, START + 1800, 4, seed=1)
+    events = make_events(5000, START, 3600) + burst
+    logs = FakeLogs(events)
+
+    results = utils._run_split_query(logs, "query", "group", START, START + 3600)
+
+    assert set(request_ids(results)) == {request_id for _, request_id in events}
+    # the burst needed windows of a few seconds, several levels below the first split
+    assert min(end - start for start, end, _ in logs.queries) <= 2
+
+
+def test_window_that_cannot_be_split_returns_the_capped_results():
+    logs = FakeLogs(make_events(12000, START, 1, seed=2))
+
+    results = utils._run_split_query(logs, "query", "group", START, START + 1)
+
+    assert len(results) == utils.QUERY_RESULTS_LIMIT
+    assert len(logs.queries) == 1
+
+
+@pytest.mark.parametrize("inclusive_end", [False, True])
+def test_run_query_drops_the_duplicates_of_the_shared_boundary_seconds(monkeypatch, inclusive_end):
+    events = make_events(45000, START, 3600, seed=3)
+    logs = FakeLogs(events, inclusive_end=inclusive_end)
+    monkeypatch.setattr(utils.boto3, "client", lambda *args, **kwargs: logs)
+
+    results = utils.run_query("query", "group", time_range=(START, START + 3600))
+
+    ids = request_ids(results)
+    assert len(ids) == len(set(ids))
+    assert set(ids) == {request_id for _, request_id in events}
+    if inclusive_end:
+        # the halves returned the events of their shared second twice
+        assert logs.rows_returned > len(events)
+
+
+def test_shards_cover_the_range_and_share_their_boundary_seconds():
+    shards = utils._get_shards(START, START + 86399, 24)
+
+    assert len(shards) == 24
+    assert shards[0][0] == START and shards[-1][1] == START + 86399
+    assert all(previous[1] == current[0] for previous, current in zip(shards, shards[1:]))
+
+
+@pytest.mark.parametrize("inclusive_end", [False, True])
+def test_run_query_returns_every_event_across_shards(monkeypatch, inclusive_end):
+    events = make_events(60000, START, 6 * 3600, seed=4)
+    logs = FakeLogs(events, inclusive_end=inclusive_end)
+    monkeypatch.setattr(utils.boto3, "client", lambda *args, **kwargs: logs)
+
+    results = utils.run_query("query", "group", time_range=(START, START + 6 * 3600))
+
+    ids = request_ids(results)
+    assert len(ids) == len(set(ids))
+    assert set(ids) == {request_id for _, request_id in events}
+
+
+def test_start_query_stops_retrying_at_the_deadline(monkeypatch):
+    class LimitExceededException(Exception):
+        pass
+
+    class ThrottledLogs:
+        class exceptions:
+            pass
+
+        def start_query(self, **kwargs):
+            raise LimitExceededException()
+
+    ThrottledLogs.exceptions.LimitExceededException = LimitExceededException
+
+    clock = {"now": 1000.0}
+    monkeypatch.setattr(utils.time, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: clock.__setitem__("now", clock["now"] + seconds))
+
+    with pytest.raises(TimeoutError):
+        utils._start_query(ThrottledLogs(), deadline=1005.0, startTime=START, endTime=START + 1, queryString="query")
+
+    assert clock["now"] <= 1005.0
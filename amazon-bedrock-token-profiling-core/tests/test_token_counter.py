@@ -0,0 +1,41 @@
+"""
+Counts tokens with the per-provider estimators of the invoke model function.
+
+    cd amazon-bedrock-token-profiling-core && python -m pytest tests
+"""
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "invoke_model"))
+
+import token_counter  # noqa: E402
+
+TEXTS = [
+    "",
+    "What is Amazon Bedrock?",
+    "Invoice 2024-06-01: 3 x 1499.99 USD, see https://example.com/a?b=c\n\nThanks!",
+    "Die Größe der Straße, 東京タワー",
+    "x" * 200,
+    "7" * 100,
+]
+
+
+@pytest.mark.parametrize("provider", sorted(token_counter.PROFILES) + [None])
+def test_batch_counts_like_single_texts(provider):
+    assert token_counter.count_tokens_batch(TEXTS, provider) == [token_counter.count_tokens(text, provider) for text in TEXTS]
+
+
+def test_count_follows_the_profile():
+    profile = {
+        "word_chars": 4, "subword_chars": 3.0, "digit_chars": 2, "punctuation_ratio": 0.5,
+        "non_ascii_ratio": 2.0, "scale": 1.0, "overhead": 3
+    }
+
+    # what: 1, is: 1, Bedrock: 3, 12345: 3, ?,!: 1, é: 2, one newline run: 1
+    assert token_counter.count_tokens_batch(["what is Bedrock? 12345!\n\né"], profile=profile) == [3 + 12]
+
+    # runs longer than the lookup tables
+    assert token_counter.count_tokens_batch(["a" * 100, "1" * 99], profile=profile) == [3 + math.ceil(100 / 3), 3 + 50]
@@ -0,0 +1,49 @@
+"""
+Sends the usage counter updates of the invoke model function through a real boto3 table, the requests are
+captured before they leave the process.
+
+    cd amazon-bedrock-token-profiling-core && python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import boto3
+from botocore.awsrequest import AWSResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "invoke_model"))
+
+from usage_counters import UsageCounters  # noqa: E402
+
+
+class RawBody:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def test_flush_sends_dynamodb_typed_values():
+    session = boto3.session.Session(region_name="us-east-1", aws_access_key_id="key", aws_secret_access_key="secret")
+    table = session.resource("dynamodb").Table("usage")
+    requests = []
+
+    def send(request, **kwargs):
+        requests.append(json.loads(request.body))
+        return AWSResponse(request.url, 200, {"Content-Type": "application/x-amz-json-1.0"}, RawBody(b"{}"))
+
+    table.meta.client.meta.events.register("before-send.dynamodb", send)
+
+    usage_counters = UsageCounters(table)
+    usage_counters.add("tenant", "model", input_tokens=10, output_tokens=20)
+    usage_counters.add("tenant", "model", input_tokens=5, output_tokens=5)
+    usage_counters.flush()
+
+    assert len(requests) == 1
+    assert requests[0]["Key"]["pk"]["S"].startswith("usage#tenant#model#")
+    values = requests[0]["ExpressionAttributeValues"]
+    assert values[":tenant_id"] == {"S": "tenant"}
+    assert values[":input_tokens"] == {"N": "15"}
+    assert values[":output_tokens"] == {"N": "25"}
+    assert values[":invocations"] == {"N": "2"}
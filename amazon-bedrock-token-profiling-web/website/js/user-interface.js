@@ -178,17 +178,8 @@ function invokeModel() {
   var myHeaders = new Headers();
   myHeaders.append("Access-Control-Allow-Origin", '*')
   myHeaders.append("Auth", localStorage['idtoken']);
-  if (model_id === "anthropic.claude-3-sonnet-20240229-v1:0") {
-    /*var process_input = {
-      "anthropic_version": "bedrock-2023-05-31",
-      "max_tokens":1000,
-      "messages": [{"role": "user", "content":{"type":"text","text": bedrock_text}}]
-    }*/
-    var raw = JSON.stringify({ "inputs": bedrock_text });
-  }
-  else {
-    var raw = JSON.stringify({ "inputs": bedrock_text, "parameters": { "maxTokenCount": 4096, "temperature": 0.8 } });
-  }
+  // the API maps the parameters to the names of each provider
+  var raw = JSON.stringify({ "inputs": bedrock_text, "parameters": { "maxTokenCount": 4096, "temperature": 0.8 } });
   var requestOptions = {
     method: 'POST',
     headers: myHeaders,
@@ -207,27 +198,50 @@ function invokeModel() {
 
 }
 
-function ddb_cost_retrieval() {
+// pages of the cost retrieval by request body, revalidated with their ETag
+var costPages = {};
+
+function ddb_cost_retrieval(cursor = null, records = []) {
   var trackURL = `${apiURL}/ddb_cost_retrieval`
   var myHeaders = new Headers();
   myHeaders.append("Access-Control-Allow-Origin", '*')
   myHeaders.append("Auth", localStorage['idtoken']);
+  var raw = JSON.stringify(cursor ? { "cursor": cursor, "limit": 1000 } : { "limit": 1000 });
+  if (costPages[raw]) {
+    myHeaders.append("If-None-Match", costPages[raw]['etag']);
+  }
   var requestOptions = {
     method: 'POST',
     headers: myHeaders,
+    body: raw,
     timeout: 5000,
   };
   fetch(trackURL, requestOptions)
     .then(response => {
-      return response.json()
+      // 304: the page has not changed since it was fetched
+      if (response.status === 304) {
+        return costPages[raw]['result'];
+      }
+      var etag = response.headers.get("ETag");
+      return response.json().then(result => {
+        if (etag) {
+          costPages[raw] = { "etag": etag, "result": result };
+        }
+        return result;
+      });
     }).then(result => {
-      console.log(result['body'])
-      console.log(result['body'].length)
+      records = records.concat(result['body'])
+
+      // the API returns one page at a time, keep following the cursor until the last page
+      if (result['cursor']) {
+        ddb_cost_retrieval(result['cursor'], records);
+        return;
+      }
+      console.log(records.length)
 
       let contentstr = '<tbody>';
-      for (let j = 0; j < result['body'].length; j++) {
-        console.log(result['body'][j])
-        let rc = result['body'][j];
+      for (let j = 0; j < records.length; j++) {
+        let rc = records[j];
         contentstr = contentstr +
           `<tr>
 						<td>${rc['name']}</td>                     